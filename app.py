@@ -4,12 +4,12 @@
 # =========================
 
 # ---------- Imports ----------
-import io
+import hashlib
 import json
 import os
-import atexit
 import datetime as dt
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -19,11 +19,21 @@ from ortools.sat.python import cp_model
 
 # 祝日自動判定（任意）
 try:
-    import jpholiday  # noqa: F401
+    import jpholiday
     HAS_JPHOLIDAY = True
 except Exception:
     HAS_JPHOLIDAY = False
 
+# 高速JSON（任意・無ければ標準json）
+try:
+    import orjson
+    HAS_ORJSON = True
+except Exception:
+    HAS_ORJSON = False
+
+# pandas 2.x の Copy-on-Write を有効化（明示的な .copy() なしでも元DFは変更されない）
+pd.set_option("mode.copy_on_write", True)
+
 
 # ---------- ページ設定 / 定数 ----------
 st.set_page_config(page_title="研修医シフト作成", page_icon="🗓️", layout="wide")
@@ -41,9 +51,6 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-from datetime import datetime
-import sys, platform, os  # noqa: E402
-
 WEEKDAY_JA = ["月", "火", "水", "木", "金", "土", "日"]
 SHIFTS = ["ER_Early", "ER_Day1", "ER_Day2", "ER_Day3", "ER_Late", "ICU", "VAC"]
 ER_BASE = ["ER_Early", "ER_Day1", "ER_Late"]
@@ -56,7 +63,46 @@ SHIFT_LABEL = {
     "ICU": "ICU",
     "VAC": "年休",
 }
+# シフト名→index（ループ内で list.index を呼ばない）
+SHIFT_IDX = {s: k for k, s in enumerate(SHIFTS)}
+SHIFT_RANGE = range(len(SHIFTS))
+E_IDX   = SHIFT_IDX["ER_Early"]
+D1_IDX  = SHIFT_IDX["ER_Day1"]
+D2_IDX  = SHIFT_IDX["ER_Day2"]
+D3_IDX  = SHIFT_IDX["ER_Day3"]
+L_IDX   = SHIFT_IDX["ER_Late"]
+ICU_IDX = SHIFT_IDX["ICU"]
+VAC_IDX = SHIFT_IDX["VAC"]
+ER_BASE_IDX = tuple((b, SHIFT_IDX[b]) for b in ER_BASE)   # (シフト名, index)
+DAY_ICU_DOWNGRADE = frozenset(("day", "icu"))            # A指定できない kind（Bへ降格）
+# 1シフトで判定できる希望種別: kind → (シフトindex, その日の枠が立っているか（DAY[d] を受け取る）)
+KIND_TABLE = {
+    "early":    (E_IDX,   lambda day: day["req"]["ER_Early"] == 1),
+    "late":     (L_IDX,   lambda day: day["req"]["ER_Late"] == 1),
+    "day1":     (D1_IDX,  lambda day: day["req"]["ER_Day1"] == 1),
+    "day2":     (D2_IDX,  lambda day: day["allow_d2"]),
+    "icu":      (ICU_IDX, lambda day: day["allow_icu"]),   # J2 限定は呼び出し側で判定
+    "vacation": (VAC_IDX, lambda day: True),
+}
 WEEKDAY_MAP = {"月": 0, "火": 1, "水": 2, "木": 3, "金": 4, "土": 5, "日": 6}
+# ICU希望比率の選択肢ラベル → 比率（"0%"〜"100%" の10%刻み）
+ICU_LABEL_TO_RATIO = {f"{i}%": i / 100.0 for i in range(0, 101, 10)}
+
+# ss.get(...) の既定値用の空テンプレート（毎回DFを生成しない / CoWなので共有しても安全）
+_EMPTY_SPECIAL = pd.DataFrame({"date": pd.Series(dtype="object"), "drop_shift": pd.Series(dtype="object")})
+_EMPTY_STAFF = pd.DataFrame(columns=["name", "grade", "desired_icu_ratio"])
+_EMPTY_PREFS = pd.DataFrame(columns=["date", "name", "kind", "priority"])
+_EMPTY_PINS = pd.DataFrame(columns=["date", "name", "shift"])
+
+
+def _normalize_prefs(df: pd.DataFrame) -> pd.DataFrame:
+    """希望表の kind を小文字・priority を大文字に正規化（保存/読込時に1回だけ行う）"""
+    if df.empty:
+        return df
+    return df.assign(
+        kind=df["kind"].astype(str).str.strip().str.lower(),
+        priority=df["priority"].astype(str).str.strip().str.upper(),
+    )
 
 # ---------- 年/月・日付ユーティリティ ----------
 this_year = dt.date.today().year
@@ -72,6 +118,10 @@ def _serialize_for_json(obj):
         return list(obj)
     return obj
 
+def _snap_fingerprint(snap_bytes: bytes) -> str:
+    """シリアライズ済みスナップショットの指紋（128bit）。重複判定用"""
+    return hashlib.blake2b(snap_bytes, digest_size=16).hexdigest()
+
 def _current_settings_as_dict():
     """現UI状態を辞書化（後でUI構築後に上書きされる値は globals() / st.session_state から読む）"""
     ss = st.session_state
@@ -128,18 +178,10 @@ def _current_settings_as_dict():
             "pref_B": weight_pref_B,
             "pref_C": weight_pref_C,
         },
-        "special_er": st.session_state.get(
-            "special_er", pd.DataFrame({"date": [], "drop_shift": []})
-        ).to_dict(orient="records"),
-        "staff": st.session_state.get(
-            "staff_df", pd.DataFrame(columns=["name", "grade", "desired_icu_ratio"])
-        ).to_dict(orient="records"),
-        "prefs": st.session_state.get(
-            "prefs", pd.DataFrame(columns=["date", "name", "kind", "priority"])
-        ).to_dict(orient="records"),
-        "pins": st.session_state.get(
-            "pins", pd.DataFrame(columns=["date", "name", "shift"])
-        ).to_dict(orient="records"),
+        "special_er": st.session_state.get("special_er", _EMPTY_SPECIAL).to_dict(orient="records"),
+        "staff": st.session_state.get("staff_df", _EMPTY_STAFF).to_dict(orient="records"),
+        "prefs": st.session_state.get("prefs", _EMPTY_PREFS).to_dict(orient="records"),
+        "pins": st.session_state.get("pins", _EMPTY_PINS).to_dict(orient="records"),
         "memo": ss.get("memo_text", ""),  # ← 作成者メモを保存
 
     }
@@ -228,9 +270,12 @@ def _apply_snapshot_dict(snap: dict):
             prefs_df["date"] = pd.to_datetime(prefs_df["date"]).dt.date
         except Exception:
             pass
-        ss.prefs = prefs_df[["date", "name", "kind", "priority"]].copy()
-        ss.prefs_draft = ss.prefs.copy()
+        ss.prefs = _normalize_prefs(prefs_df[["date", "name", "kind", "priority"]])
+        ss.prefs_draft = ss.prefs
         ss.prefs_editor_ver = ss.get("prefs_editor_ver", 0) + 1
+    # 復元前の操作の「元に戻す」は、復元後の希望に対しては無効
+    ss.prefs_backup = None
+    ss.last_bulk_add_rows = []
 
     # pins
     pins_df = pd.DataFrame(snap.get("pins", []))
@@ -290,12 +335,14 @@ def make_snapshot(
         fair_slack_val = int(STAR_TO_FAIR_SLACK.get(fair_star, 2))
 
     if special_map is None:
-        spdf = ss.get("special_er", pd.DataFrame({"date": [], "drop_shift": []}))
-        special_map = {r["date"]: r["drop_shift"] for _, r in spdf.iterrows() if pd.notna(r.get("date"))}
+        spdf = ss.get("special_er", _EMPTY_SPECIAL)
+        special_map = {
+            d: sh for d, sh in spdf.reindex(columns=["date", "drop_shift"]).itertuples(index=False, name=None) if pd.notna(d)
+        }
 
-    staff_df = staff_df if staff_df is not None else ss.get("staff_df", pd.DataFrame(columns=["name", "grade", "desired_icu_ratio"]))
-    prefs_df = prefs_df if prefs_df is not None else ss.get("prefs", pd.DataFrame(columns=["date", "name", "kind", "priority"]))
-    pins_df = pins_df if pins_df is not None else ss.get("pins", pd.DataFrame(columns=["date", "name", "shift"]))
+    staff_df = staff_df if staff_df is not None else ss.get("staff_df", _EMPTY_STAFF)
+    prefs_df = prefs_df if prefs_df is not None else ss.get("prefs", _EMPTY_PREFS)
+    pins_df = pins_df if pins_df is not None else ss.get("pins", _EMPTY_PINS)
 
     return {
         "run": {
@@ -344,8 +391,20 @@ def make_snapshot(
         "memo": (memo_text if memo_text is not None else ss.get("memo_text", "")),  
     }
 
+def _snapshot_state_sig():
+    """現在の画面状態（年月・祝日/休診日・設定・スタッフ・希望・固定・メモ）の内容指紋。適用直後から変わったかの判定用"""
+    return _snap_fingerprint(
+        json.dumps(_current_settings_as_dict(), ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    )
+
 def apply_snapshot(js: dict):
     """JSON直読み（ファイル/テキストから）→ セッションに反映して rerun"""
+    ss = st.session_state
+    fp = _snap_fingerprint(json.dumps(js, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    last = ss.get("_last_snapshot_fp")
+    if last is not None and last[0] == fp and last[1] == _snapshot_state_sig():
+        st.info("同一スナップショットが適用済みのため、スキップしました。")
+        return
     try:
         per = js.get("period", {})
         if "year" in per and "month" in per:
@@ -411,11 +470,14 @@ def apply_snapshot(js: dict):
                     )
                 except Exception:
                     pass
-            return pd.DataFrame(rows)
+            return _normalize_prefs(pd.DataFrame(rows, columns=["date", "name", "kind", "priority"]))
 
         st.session_state.prefs = parse_prefs(js.get("prefs", []))
-        st.session_state.prefs_draft = st.session_state.prefs.copy()
+        st.session_state.prefs_draft = st.session_state.prefs
         st.session_state.prefs_editor_ver = st.session_state.get("prefs_editor_ver", 0) + 1
+        # 適用前の操作の「元に戻す」は、読み込んだ希望に対しては無効
+        st.session_state.prefs_backup = None
+        st.session_state.last_bulk_add_rows = []
 
         # pins
         def parse_pins(lst):
@@ -436,6 +498,8 @@ def apply_snapshot(js: dict):
 
         st.session_state.memo_text = js.get("memo", st.session_state.get("memo_text", ""))  
 
+        # 状態の指紋は反映後の再描画で取る（祝日・休診日などはウィジェット生成時に確定するため）
+        ss["_last_snapshot_fp"] = (fp, None)
         st.success("スナップショットを読み込みました。年/月・祝日等を反映するため再描画します。")
         st.rerun()
     except Exception as e:
@@ -451,7 +515,7 @@ def _init_state():
     if "prefs" not in ss:
         ss.prefs = pd.DataFrame(columns=["date", "name", "kind", "priority"])
     if "prefs_draft" not in ss:
-        ss.prefs_draft = ss.prefs.copy()
+        ss.prefs_draft = ss.prefs
     if "prefs_editor_ver" not in ss:
         ss.prefs_editor_ver = 0
     if "prefs_backup" not in ss:
@@ -511,50 +575,56 @@ month = st.sidebar.selectbox(
 )
 
 # 3) 日付リスト等
-start_date = dt.date(year, month, 1)
-end_date = dt.date(year + (month == 12), (month % 12) + 1, 1) - dt.timedelta(days=1)
-all_days = [d.date() for d in rrule(DAILY, dtstart=start_date, until=end_date)]
-D = len(all_days)
-
 def date_label(d: dt.date) -> str:
     return f"{d}({WEEKDAY_JA[d.weekday()]})"
 
-DATE_OPTIONS = [date_label(d) for d in all_days]
-LABEL_TO_DATE = {date_label(d): d for d in all_days}
-DATE_TO_LABEL = {d: date_label(d) for d in all_days}
+@st.cache_data(show_spinner=False)
+def _month_labels(year: int, month: int):
+    """(year, month) だけで決まる日付リストと日付ラベルの対応表（rerun ごとに作り直さない）"""
+    start = dt.date(year, month, 1)
+    end = dt.date(year + (month == 12), (month % 12) + 1, 1) - dt.timedelta(days=1)
+    days = [d.date() for d in rrule(DAILY, dtstart=start, until=end)]
+    labels = [date_label(d) for d in days]
+    return days, labels, dict(zip(labels, days)), dict(zip(days, labels))
+
+all_days, DATE_OPTIONS, LABEL_TO_DATE, DATE_TO_LABEL = _month_labels(year, month)
+start_date, end_date = all_days[0], all_days[-1]
+D = len(all_days)
+all_days_set = set(all_days)                             # 所属判定用
+all_days_index = {d: i for i, d in enumerate(all_days)}  # 日付 → 日index
 
 # --- placeholders for static checker (will be overwritten by UI) ---
 holidays: list[dt.date] = []
 closed_days: list[dt.date] = []
 
 # --- 祝日：自動取得ヘルパー & UI ---
+@st.cache_data(ttl=3600, show_spinner=False)
 def _jp_holidays_for(year: int, month: int) -> list[dt.date]:
-    """当月の日本の祝日リスト（jpholiday が無い/失敗なら空）"""
+    """当月の日本の祝日リスト（jpholiday が無い/失敗なら空）。rerun ごとに引き直さない"""
+    if not HAS_JPHOLIDAY:
+        return []
     try:
-        import jpholiday
-        from calendar import monthrange
-        last_day = monthrange(year, month)[1]
-        start = dt.date(year, month, 1)
-        end   = dt.date(year, month, last_day)
-        days = [d.date() for d in rrule(DAILY, dtstart=start, until=end)]
-        return [d for d in days if jpholiday.is_holiday(d)]
+        return [d for d in _month_labels(year, month)[0] if jpholiday.is_holiday(d)]
     except Exception:
         return []
 
 # --- state 初期化 / 再取得制御（ウィジェット生成前に済ませる） ---
+# 当月外の日付の除去は (year, month) が変わったときだけ行う（ウィジェット経由の値は常に当月内）
+_month_changed = st.session_state.get("_days_trim_sig") != (year, month)
+st.session_state["_days_trim_sig"] = (year, month)
+
 _restore = st.session_state.pop("_restore_holidays", None)
-if _restore is not None:
-    initial_holidays = [d for d in _restore if d in all_days]
-else:
-    initial_holidays = [d for d in _jp_holidays_for(year, month) if d in all_days]
 
 if st.session_state.pop("_refresh_holidays", False):
-    st.session_state["holidays_ms"] = [d for d in _jp_holidays_for(year, month) if d in all_days]
+    st.session_state["holidays_ms"] = _jp_holidays_for(year, month)
 
 if "holidays_ms" not in st.session_state:
-    st.session_state["holidays_ms"] = initial_holidays
-else:
-    st.session_state["holidays_ms"] = [d for d in st.session_state["holidays_ms"] if d in all_days]
+    if _restore is not None:
+        st.session_state["holidays_ms"] = [d for d in _restore if d in all_days_set]
+    else:
+        st.session_state["holidays_ms"] = _jp_holidays_for(year, month)
+elif _month_changed:
+    st.session_state["holidays_ms"] = [d for d in st.session_state["holidays_ms"] if d in all_days_set]
 
 # ---- UI（祝日）----
 holbox = st.sidebar.container()
@@ -562,12 +632,7 @@ with holbox:
     head_l, head_r = st.columns([1, 0.22])
     with head_l:
         st.markdown("#### 祝日（当月）")
-        try:
-            import jpholiday  # noqa: F401
-            _hol_ok = True
-        except Exception:
-            _hol_ok = False
-        st.caption("✅ 自動取得ON" if _hol_ok else "❌ 自動取得OFF（`pip install jpholiday`）")
+        st.caption("✅ 自動取得ON" if HAS_JPHOLIDAY else "❌ 自動取得OFF（`pip install jpholiday`）")
 
     with head_r:
         if st.button("🔄", key="btn_refresh_holidays", help="祝日を再取得"):
@@ -588,9 +653,9 @@ holidays = st.session_state["holidays_ms"]
 # === 病院休診日 ===
 _restore_closed = st.session_state.pop("_restore_closed_days", None)
 if "closed_ms" not in st.session_state:
-    st.session_state["closed_ms"] = [d for d in (_restore_closed or []) if d in all_days]
-else:
-    st.session_state["closed_ms"] = [d for d in st.session_state["closed_ms"] if d in all_days]
+    st.session_state["closed_ms"] = [d for d in (_restore_closed or []) if d in all_days_set]
+elif _month_changed:
+    st.session_state["closed_ms"] = [d for d in st.session_state["closed_ms"] if d in all_days_set]
 
 closed_box = st.sidebar.container()
 with closed_box:
@@ -747,6 +812,21 @@ with st.sidebar.expander("⚙️ 詳細ウェイト設定", expanded=False):
     else:
         s_fatigue = 2  # 有効でない場合も仮に★2扱い（重みは0で後処理）
 
+    # --- ソルバー詳細（上級者向け。既定値は CP-SAT の標準設定のまま） ---
+    st.markdown("**ソルバー詳細**")
+    solver_linearization = st.selectbox(
+        "LP緩和の強さ（linearization_level）", [0, 1, 2], index=1, key="solver_linearization",
+        help="2にすると基数制約にもLP緩和を張ります。並列探索（再現性OFF）で効きやすく、1スレッドでは遅くなることがあります。"
+    )
+    solver_symmetry = st.selectbox(
+        "対称性の検出（symmetry_level）", [0, 1, 2, 3, 4], index=2, key="solver_symmetry",
+        help="同条件のスタッフの入れ替えなど、等価な解の探索を省く度合い。"
+    )
+    solver_core = st.checkbox(
+        "コアベースの目的探索（optimize_with_core）", value=False, key="solver_core",
+        help="下界側から最適性を詰める探索に切り替えます。この勤務表モデルでは1スレッドだと制限時間内に最適解へ届かないことが多いため既定はOFFです。"
+    )
+
 # ★→実数ウェイトの変換（1〜3のみ）
 STAR_TO_WEIGHT_DAY_WEEKDAY = {1: 2.0, 2: 6.0, 3: 12.0}
 STAR_TO_WEIGHT_WED_BONUS   = {1: 4.0, 2: 8.0, 3: 12.0}
@@ -785,22 +865,53 @@ def _json_default(o):
     return str(o)
 
 def save_last_snapshot_to_disk():
-    """現在のUI状態を app.py と同じディレクトリに保存"""
+    """現在のUI状態を app.py と同じディレクトリに保存（一時ファイル→os.replace で原子的に置換）"""
     try:
         payload = _current_settings_as_dict()
-        with open(LAST_SNAPSHOT_FILE, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2, default=_json_default)
+        if HAS_ORJSON:
+            data = orjson.dumps(
+                payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS, default=_json_default
+            )
+        else:
+            data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+        # 前回保存と同一内容でファイルも残っていれば書き込みを省略
+        h = _snap_fingerprint(data)
+        if h == st.session_state.get("_last_snap_hash") and os.path.exists(LAST_SNAPSHOT_FILE):
+            return True, None
+        tmp = LAST_SNAPSHOT_FILE + ".tmp"
+        with open(tmp, "wb", buffering=1 << 16) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, LAST_SNAPSHOT_FILE)
+        st.session_state["_last_snap_hash"] = h
         return True, None
     except Exception as e:
         return False, str(e)
 
+@st.cache_data(ttl=2, show_spinner=False)
+def _stat_snapshot(path):
+    """保存ファイルの os.stat 結果（無ければ None）"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
 def load_last_snapshot_from_disk():
     """スナップショットdictを返す（ここでは適用しない）"""
     try:
-        if os.path.exists(LAST_SNAPSHOT_FILE):
-            with open(LAST_SNAPSHOT_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        return None
+        st_ = _stat_snapshot(LAST_SNAPSHOT_FILE)
+        if st_ is None:
+            return None
+        # 前回読み込み時から更新されていなければパース済みdictを再利用
+        cached = st.session_state.get("_snap_cache")
+        if cached is not None and cached[0] == st_.st_mtime_ns:
+            return cached[1]
+        with open(LAST_SNAPSHOT_FILE, "rb") as f:
+            raw = f.read()
+        snap = orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
+        st.session_state["_snap_cache"] = (st_.st_mtime_ns, snap)
+        return snap
     except Exception as e:
         st.sidebar.warning(f"読み込みに失敗: {e}")
         return None
@@ -810,10 +921,11 @@ st.sidebar.divider()
 st.sidebar.subheader("🧷 前回状態（ディスク）")
 
 # 状態表示（ファイルの有無/更新時刻/サイズ）
-if os.path.exists(LAST_SNAPSHOT_FILE):
+_snap_stat = _stat_snapshot(LAST_SNAPSHOT_FILE)
+if _snap_stat is not None:
     try:
-        mtime = dt.datetime.fromtimestamp(os.path.getmtime(LAST_SNAPSHOT_FILE)).strftime("%Y-%m-%d %H:%M:%S")
-        size_kb = os.path.getsize(LAST_SNAPSHOT_FILE) / 1024.0
+        mtime = dt.datetime.fromtimestamp(_snap_stat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+        size_kb = _snap_stat.st_size / 1024.0
         st.sidebar.caption(f"📄 保存あり: {mtime}（{size_kb:.1f} KB）\nパス: {LAST_SNAPSHOT_FILE}")
     except Exception:
         st.sidebar.caption("📄 保存あり（情報取得に失敗）")
@@ -824,6 +936,7 @@ c_a, c_b = st.sidebar.columns(2)
 
 if c_a.button("💾 保存", key="btn_save_to_disk", use_container_width=True):
     ok, err = save_last_snapshot_to_disk()
+    _stat_snapshot.clear()
     if ok:
         st.sidebar.success("保存しました。")
     else:
@@ -846,6 +959,11 @@ st.sidebar.caption(
     "過去にダウンロードしたスナップショットJSONを読み込むと、"
     "画面状態を一括復元できます。"
 )
+# 直前に適用したスナップショットがあれば、反映後の状態の指紋をここで記録する
+_last_fp = st.session_state.get("_last_snapshot_fp")
+if _last_fp is not None and _last_fp[1] is None:
+    st.session_state["_last_snapshot_fp"] = (_last_fp[0], _snapshot_state_sig())
+
 up_snap = st.sidebar.file_uploader(
     "JSONを選択して『UIに反映』",
     type=["json"],
@@ -862,21 +980,16 @@ if up_snap is not None and apply_up_btn:
     except Exception as e:
         st.sidebar.error(f"JSONの読み込みに失敗しました: {e}")
 
-# -------------------------
-# 休日集合（後続の表示や検証で利用）
-# -------------------------
-H = set(d for d in all_days if d.weekday() >= 5) | set(holidays)
-
 # -------------------------
 # ER特例（画面では編集せずセッションから辞書化）
 # -------------------------
-_special_df = st.session_state.special_er.copy() if "special_er" in st.session_state else pd.DataFrame(columns=["date", "drop_shift"])
+_special_df = st.session_state.get("special_er", _EMPTY_SPECIAL)
 if not _special_df.empty:
     _special_df = _special_df.dropna()
     if "date" in _special_df.columns:
-        _special_df = _special_df[_special_df["date"].isin(all_days)]
+        _special_df = _special_df[_special_df["date"].isin(all_days_set)]
     _special_df = _special_df.drop_duplicates(subset=["date"], keep="last")
-special_map = {row["date"]: row["drop_shift"] for _, row in _special_df.iterrows()}
+special_map = dict(_special_df.reindex(columns=["date", "drop_shift"]).itertuples(index=False, name=None))
 
 # -------------------------
 # スタッフ入力
@@ -911,7 +1024,7 @@ with st.form("staff_form", clear_on_submit=False):
             "delete": st.column_config.CheckboxColumn("削除", help="削除したい行にチェック"),
             "name": st.column_config.TextColumn("名前", help="例：田中、田中一など"),
             "grade": st.column_config.SelectboxColumn("区分", options=["J1", "J2"], help="J1はICU不可（自動で0%固定）"),
-            "icu_ratio_label": st.column_config.SelectboxColumn("ICU希望比率", options=[f"{i}%" for i in range(0, 101, 10)]),
+            "icu_ratio_label": st.column_config.SelectboxColumn("ICU希望比率", options=list(ICU_LABEL_TO_RATIO)),
             "_rid": st.column_config.NumberColumn("rid", disabled=True),
         },
         key="staff_editor",
@@ -932,24 +1045,24 @@ with st.form("staff_form", clear_on_submit=False):
 
         if "delete" not in df.columns:
             df["delete"] = False
-        df["delete"] = df["delete"].fillna(False).apply(lambda v: bool(v) if pd.notna(v) else False)
+        df["delete"] = df["delete"].fillna(False).astype(bool)
         if del_staff:
             df = df[~df["delete"]].copy()
 
         df["name"] = df["name"].astype(str).str.strip()
-        df["grade"] = (
-            df["grade"].astype(str).str.upper().where(df["grade"].astype(str).str.upper().isin(["J1", "J2"]), "J1")
-        )
+        grade = df["grade"].astype(str).str.upper()
+        df["grade"] = grade.where(grade.isin(["J1", "J2"]), "J1")
         df["icu_ratio_label"] = df["icu_ratio_label"].astype(str).str.strip()
         df = df[df["name"] != ""].copy()
 
-        def lbl_to_ratio(s):
-            try:
-                return float(str(s).replace("%", "")) / 100.0
-            except Exception:
-                return 0.0
-
-        df["desired_icu_ratio"] = df["icu_ratio_label"].map(lbl_to_ratio)
+        # "30%" → 0.3。選択肢外（スナップショット由来の "25%" など）だけ文字列を解釈し、読めない値は 0
+        ratio = df["icu_ratio_label"].map(ICU_LABEL_TO_RATIO)
+        miss = ratio.isna()
+        if miss.any():
+            ratio[miss] = pd.to_numeric(
+                df.loc[miss, "icu_ratio_label"].str.replace("%", "", regex=False), errors="coerce"
+            ) / 100.0
+        df["desired_icu_ratio"] = ratio.fillna(0.0)
         df.loc[df["grade"] == "J1", "desired_icu_ratio"] = 0.0
 
         if df["name"].duplicated().any():
@@ -962,16 +1075,24 @@ with st.form("staff_form", clear_on_submit=False):
             st.rerun()
 
 # 実体のスタッフDF
-staff_df = st.session_state.get("staff_df", pd.DataFrame(columns=["name", "grade", "desired_icu_ratio"])).copy()
+staff_df = st.session_state.get("staff_df", _EMPTY_STAFF)
 if staff_df.empty:
     st.warning("少なくとも1名入力してください。")
     st.stop()
 
+@st.cache_data(show_spinner=False)
+def _staff_index(names_tuple, grades_tuple):
+    """氏名→index と J1/J2 の index リスト（スタッフ内容が変わらない限り再計算しない）"""
+    grades = np.asarray(grades_tuple, dtype=object)
+    name_to_idx = {n: i for i, n in enumerate(names_tuple)}
+    J1_idx = np.flatnonzero(grades == "J1").tolist()
+    J2_idx = np.flatnonzero(grades == "J2").tolist()
+    return name_to_idx, J1_idx, J2_idx
+
 names = staff_df["name"].tolist()
 N = len(names)
-name_to_idx = {n: i for i, n in enumerate(names)}
-J1_idx = [i for i in range(N) if staff_df.iloc[i]["grade"] == "J1"]
-J2_idx = [i for i in range(N) if staff_df.iloc[i]["grade"] == "J2"]
+name_to_idx, J1_idx, J2_idx = _staff_index(tuple(names), tuple(staff_df["grade"].tolist()))
+J1_set, J2_set = frozenset(J1_idx), frozenset(J2_idx)   # 所属判定用
 
 # -------------------------
 # 一括登録（B/C）
@@ -1011,12 +1132,12 @@ with st.form("bulk_prefs_form", clear_on_submit=False):
     submitted = st.form_submit_button("＋ 一括追加（B/Cのみ）", type="primary", use_container_width=True)
 
 if submitted:
-    H_set = set(d for d in all_days if d.weekday() >= 5) | set(holidays)
     if scope == "毎週指定曜日":
         sel_wd = WEEKDAY_MAP.get(sel_wd_label, 2)
         target_days = [d for d in all_days if d.weekday() == sel_wd]
     elif scope == "全休日":
-        target_days = [d for d in all_days if d in H_set]
+        hol_set = set(holidays)
+        target_days = [d for d in all_days if d.weekday() >= 5 or d in hol_set]
     elif scope == "全平日":
         target_days = [d for d in all_days if d.weekday() < 5]
     else:
@@ -1025,34 +1146,30 @@ if submitted:
     if bulk_prio not in ("B", "C"):
         st.warning("Aは一括登録の対象外です。個別に追加してください。")
     else:
-        existing = st.session_state.prefs.copy()
+        existing = st.session_state.prefs
         add_rows = []
         skipped_j1_icu = 0
+        # 既存キーと J1 名をループ前に1回だけ集合化（行ごとのDF走査をしない）
+        existing_keys = set(existing[["date", "name", "kind", "priority"]].itertuples(index=False, name=None))
+        j1_name_set = {names[i] for i in J1_idx}
         for d in target_days:
             for nm in selected_names:
-                if bulk_kind == "icu":
-                    if staff_df.loc[staff_df["name"] == nm, "grade"].iloc[0] == "J1":
-                        skipped_j1_icu += 1
-                        continue
-                dup = (
-                    existing[
-                        (existing["date"] == d)
-                        & (existing["name"] == nm)
-                        & (existing["kind"] == bulk_kind)
-                        & (existing["priority"] == bulk_prio)
-                    ].shape[0]
-                    > 0
-                )
-                if not dup:
-                    add_rows.append({"date": d, "name": nm, "kind": bulk_kind, "priority": bulk_prio})
+                if bulk_kind == "icu" and nm in j1_name_set:
+                    skipped_j1_icu += 1
+                    continue
+                key = (d, nm, bulk_kind, bulk_prio)
+                if key in existing_keys:
+                    continue
+                existing_keys.add(key)
+                add_rows.append({"date": d, "name": nm, "kind": bulk_kind, "priority": bulk_prio})
 
         if add_rows:
-            st.session_state.prefs_backup = existing.copy(deep=True)
+            # 取り消し用には差分（追加行）だけを保持する
+            st.session_state.prefs_backup = ("add", add_rows)
             st.session_state.prefs = pd.concat([existing, pd.DataFrame(add_rows)], ignore_index=True)
             st.session_state.last_bulk_add_rows = add_rows
-            tmp = st.session_state.prefs.copy()
-            tmp["date"] = pd.to_datetime(tmp.get("date"), errors="coerce").dt.date
-            st.session_state.prefs_draft = tmp
+            # 日付列の正規化はエディタ描画時に行うので、ここでは同じDFを参照させるだけ（CoW）
+            st.session_state.prefs_draft = st.session_state.prefs
             st.session_state.prefs_editor_ver += 1
 
             msg = f"{len(add_rows)} 件を追加しました。"
@@ -1066,6 +1183,24 @@ if submitted:
                 info += f" J1→ICUの希望 {skipped_j1_icu} 件は無視しました。"
             st.info(info)
 
+# 直前の一括追加/保存を取り消す
+if st.session_state.prefs_backup is not None:
+    if st.button("↩️ 直前の希望変更を取り消す", key="btn_undo_prefs"):
+        op, payload = st.session_state.prefs_backup
+        cur = st.session_state.prefs
+        if op == "add":
+            cols = ["date", "name", "kind", "priority"]
+            added = pd.MultiIndex.from_tuples([tuple(r[c] for c in cols) for r in payload], names=cols)
+            keep = ~pd.MultiIndex.from_frame(cur[cols]).isin(added)
+            st.session_state.prefs = cur[keep].reset_index(drop=True)
+        else:
+            st.session_state.prefs = payload
+        st.session_state.prefs_draft = st.session_state.prefs
+        st.session_state.prefs_editor_ver += 1
+        st.session_state.prefs_backup = None
+        st.session_state.last_bulk_add_rows = []
+        st.rerun()
+
 # -------------------------
 # 希望（A/B/C）エディタ
 # -------------------------
@@ -1073,7 +1208,7 @@ st.subheader("📝 希望")
 st.caption("※ A=絶対;冠婚葬祭など / B=強く希望;旅行予定など / C=できれば;その他の用事など")
 st.caption("入力完了後に必ず保存ボタンを押してください。そうでないと、変更が反映されません。")
 
-draft = st.session_state.prefs_draft.copy()
+draft = st.session_state.prefs_draft.copy()   # 浅いコピー（CoW なのでデータ本体は複製されない）。列代入をセッション側に波及させない
 if "date" in draft.columns:
     draft["date"] = pd.to_datetime(draft["date"], errors="coerce").dt.date
 else:
@@ -1109,15 +1244,16 @@ with st.form("prefs_save_form", clear_on_submit=False):
         df = df[df["date"].notna()]
         df["kind"] = df["kind"].astype(str).str.strip().str.lower()
         df["priority"] = df["priority"].astype(str).str.strip().str.upper()
-        bad_mask = (df["priority"] == "A") & (df["kind"].isin(["day", "icu"]))
+        bad_mask = (df["priority"] == "A") & (df["kind"].isin(DAY_ICU_DOWNGRADE))
         df.loc[bad_mask, "priority"] = "B"
         df = df[df["kind"].isin(["off", "early", "late", "day", "day1", "day2", "icu", "vacation"])]
         df = df[df["name"].isin(names)]
         df = df.drop_duplicates(subset=["date", "name", "kind", "priority"], keep="last").reset_index(drop=True)
 
-        st.session_state.prefs_backup = st.session_state.prefs.copy(deep=True)
+        # CoW なので旧DFは参照を保持するだけでよい（複製しない）
+        st.session_state.prefs_backup = ("replace", st.session_state.prefs)
         st.session_state.prefs = df
-        st.session_state.prefs_draft = df.copy()
+        st.session_state.prefs_draft = df
         st.session_state.prefs_editor_ver += 1
         st.success("希望を保存しました。")
         st.rerun()
@@ -1185,14 +1321,14 @@ with st.form("pins_form", clear_on_submit=False):
 
         # J1 の ICU プリアサインは無効化（警告表示）
         if not pins.empty:
-            j1_names = set(staff_df.loc[staff_df["grade"] == "J1", "name"].tolist())
+            j1_names = {names[i] for i in J1_idx}
             bad = (pins["shift"] == "ICU") & (pins["name"].isin(j1_names))
             if bad.any():
-                bad_rows = pins[bad][["date", "name"]].to_records(index=False).tolist()
+                bad_df = pins.loc[bad, ["date", "name"]]
                 pins = pins[~bad]
                 st.error(
                     "J1 に ICU のプリアサインは無効化しました:\n"
-                    + "\n".join([f"- {d} {n}" for d, n in bad_rows])
+                    + "\n".join(f"- {d} {n}" for d, n in zip(bad_df["date"], bad_df["name"]))
                 )
 
         pins = pins[["date", "name", "shift"]]
@@ -1208,35 +1344,112 @@ with st.form("pins_form", clear_on_submit=False):
 # app.py — Part 3 / 4
 # =========================
 
+# -------------------------
+# 日ごとのメタ情報（枠・可否）— 入力が同じ間は再計算しない
+# -------------------------
+@st.cache_data(show_spinner=False)
+def _compute_day_meta(all_days_tuple, holidays_tuple, closed_tuple, allow_day3, allow_weekend_icu, special_map_items):
+    """DAY（日ごとの枠・可否）と 休日集合H / Day2禁止日 / ICU可能日 / R2・R3・W を1パスでまとめて返す"""
+    special = dict(special_map_items)
+    hol_set, closed_set = set(holidays_tuple), set(closed_tuple)
+    h_set, weekdays, icu_allowed = set(hol_set), set(), set()
+    day2_forbid = hol_set | closed_set
+    DAY = {}
+    R2 = R3 = W = 0
+    for d, day in enumerate(all_days_tuple):
+        wd = day.weekday()
+        if wd >= 5:
+            h_set.add(day)
+            day2_forbid.add(day)
+        else:
+            weekdays.add(day)
+        d2_ok = wd < 5 and day not in day2_forbid
+        icu_ok = bool(allow_weekend_icu) or wd < 5
+        if icu_ok:
+            icu_allowed.add(day)
+
+        # 日ごとの枠・可否（特例と休日設定を反映）
+        req = {"ER_Early": 1, "ER_Day1": 1, "ER_Late": 1}
+        drop = special.get(day)
+        if drop in ER_BASE:
+            req[drop] = 0
+        else:
+            drop = None
+        DAY[d] = {"req": req, "allow_d2": d2_ok, "allow_d3": d2_ok and bool(allow_day3), "allow_icu": icu_ok, "drop": drop}
+
+        R2 += d2_ok
+        R3 += d2_ok and bool(allow_day3)
+        W += icu_ok
+
+    # 同じ内容を長さ D の bool 配列でも持つ（モデル構築で日ごとの dict を引かずに済む）
+    req_arr = {b: np.array([DAY[d]["req"][b] == 1 for d in DAY], dtype=bool) for b in ER_BASE}
+    allow_arr = {k: np.array([DAY[d][k] for d in DAY], dtype=bool) for k in ("allow_d2", "allow_d3", "allow_icu")}
+    # 曜日（0=月…6=日）と休日（土日∪祝日）フラグも日index順の配列で持つ
+    wd_arr = np.fromiter((day.weekday() for day in all_days_tuple), dtype=np.int8, count=len(all_days_tuple))
+    hol_arr = np.fromiter((day in h_set for day in all_days_tuple), dtype=bool, count=len(all_days_tuple))
+
+    return {
+        "DAY": DAY,
+        "REQ": req_arr,
+        "ALLOW": allow_arr,
+        "WD": wd_arr,
+        "IS_HOL": hol_arr,
+        "H": h_set,
+        "DAY2_FORBID": day2_forbid,
+        "WEEKDAYS": weekdays,
+        "ICU_ALLOWED": icu_allowed,
+        "R2": int(R2),
+        "R3": int(R3),
+        "W": int(W),
+    }
+
+DAY_META = _compute_day_meta(
+    tuple(all_days), tuple(holidays), tuple(closed_days),
+    bool(allow_day3), bool(allow_weekend_icu), tuple(special_map.items()),
+)
+H = DAY_META["H"]
+DAY2_FORBID = DAY_META["DAY2_FORBID"]
+WEEKDAYS = DAY_META["WEEKDAYS"]
+ICU_ALLOWED_DAYS = DAY_META["ICU_ALLOWED"]
+
 # -------------------------
 # 可否カレンダー（Day2/Day3/ICU）
 # -------------------------
-DAY2_FORBID = set([d for d in all_days if d.weekday() >= 5]) | set(holidays) | set(closed_days)
-WEEKDAYS = set([d for d in all_days if d.weekday() < 5])
-ICU_ALLOWED_DAYS = set(all_days) if allow_weekend_icu else WEEKDAYS
 
-cal_rows = []
-for d in all_days:
-    cal_rows.append(
+@st.cache_data(show_spinner=False)
+def _calendar_frame(all_days_tuple, day2_forbid_tuple, icu_allowed_tuple, h_tuple, closed_tuple, allow_day3):
+    """可否カレンダー表を列単位で組み立てる"""
+    days = pd.Series(all_days_tuple, dtype=object)
+    wd = np.fromiter((d.weekday() for d in all_days_tuple), dtype=np.int8, count=len(all_days_tuple))
+    d2_ok = (wd < 5) & ~days.isin(day2_forbid_tuple).to_numpy()
+    if allow_day3:
+        d3 = np.where(d2_ok, "🟢可", "🔴不可")
+    else:
+        d3 = np.full(len(days), "—", dtype=object)
+    is_h = days.isin(h_tuple).to_numpy()
+    is_closed = days.isin(closed_tuple).to_numpy()
+    return pd.DataFrame(
         {
-            "Date": str(d),
-            "Weekday": WEEKDAY_JA[d.weekday()],
-            "D2": "🟢可" if (d.weekday() < 5 and d not in DAY2_FORBID) else "🔴不可",
-            "D3": ("🟢可" if (allow_day3 and d.weekday() < 5 and d not in DAY2_FORBID) else ("—" if not allow_day3 else "🔴不可")),
-            "ICU": "可" if (d in ICU_ALLOWED_DAYS) else "不可",
-            "Holiday/Closed": ("休" if d in H else "") + (" 休診" if d in set(closed_days) else ""),
+            "Date": days.astype(str).to_numpy(),
+            "Weekday": np.asarray(WEEKDAY_JA, dtype=object)[wd],
+            "D2": np.where(d2_ok, "🟢可", "🔴不可"),
+            "D3": d3,
+            "ICU": np.where(days.isin(icu_allowed_tuple).to_numpy(), "可", "不可"),
+            "Holiday/Closed": np.char.add(np.where(is_h, "休", ""), np.where(is_closed, " 休診", "")),
         }
     )
-cal_df = pd.DataFrame(cal_rows)
+
+cal_df = _calendar_frame(
+    tuple(all_days), tuple(sorted(DAY2_FORBID)), tuple(sorted(ICU_ALLOWED_DAYS)),
+    tuple(sorted(H)), tuple(closed_days), bool(allow_day3),
+)
 with st.expander("🗓️ Day2/Day3/ICU の設置可否カレンダー"):
     st.dataframe(cal_df, use_container_width=True, hide_index=True)
 
 # -------------------------
 # 前処理バリデーション（ボリューム等）
 # -------------------------
-R2 = len([d for d in all_days if (d.weekday() < 5 and d not in DAY2_FORBID)])
-R3 = len([d for d in all_days if (allow_day3 and d.weekday() < 5 and d not in DAY2_FORBID)])
-W = len([d for d in all_days if d in ICU_ALLOWED_DAYS])
+R2, R3, W = DAY_META["R2"], DAY_META["R3"], DAY_META["W"]
 
 sum_target = int(per_person_total) * N
 min_required = 3 * D
@@ -1270,69 +1483,58 @@ if sum_J1 > max_ER_slots_info:
 def validate_A_requests(prefs_df: pd.DataFrame, DAY_template: dict) -> list[str]:
     """A希望の物理不可能を早期チェック"""
     issues = []
-    a_off = set()
 
-    # A-休みの集合
-    for _, r in prefs_df[(prefs_df["priority"] == "A") & (prefs_df["kind"].str.lower() == "off")].iterrows():
-        if r["date"] in all_days and r["name"] in name_to_idx:
-            a_off.add((r["date"], r["name"]))
+    # A希望だけを1回抽出し、日付/名前の有効判定と日index・当日の枠/可否を列として付与
+    a_df = prefs_df.loc[prefs_df["priority"].eq("A"), ["date", "name", "kind"]]
+    a_df = a_df.assign(kind=a_df["kind"].astype(str).str.lower())
+    date_ok = a_df["date"].isin(all_days_set)
+    valid = date_ok & a_df["name"].isin(name_to_idx.keys())
 
     # A-休みと同日の他A
-    for _, r in prefs_df[prefs_df["priority"] == "A"].iterrows():
-        d, nm, k = r["date"], r["name"], str(r["kind"]).lower()
-        if d not in all_days or nm not in name_to_idx:
-            continue
-        if (d, nm) in a_off and k != "off":
-            issues.append(f"{d} {nm}: A-休み と A-{k} は同日に共存できません")
-        if (d, nm) in a_off and k == "vacation":
+    off = a_df.loc[valid & a_df["kind"].eq("off")]
+    a_off_pairs = set(zip(off["date"], off["name"]))
+    same_day = pd.MultiIndex.from_frame(a_df[["date", "name"]]).isin(a_off_pairs)
+    for d, nm, k in a_df.loc[valid & same_day & a_df["kind"].ne("off")].itertuples(index=False, name=None):
+        issues.append(f"{d} {nm}: A-休み と A-{k} は同日に共存できません")
+        if k == "vacation":
             issues.append(f"{d} {nm}: A-休み と A-vacation は同日に共存できません")
 
     # J1のA-ICUは不可
-    j1_names = set(staff_df.loc[staff_df["grade"] == "J1", "name"].tolist())
-    for _, r in prefs_df[(prefs_df["priority"] == "A") & (prefs_df["kind"].str.lower() == "icu")].iterrows():
-        if r["name"] in j1_names:
-            issues.append(f"{r['date']} {r['name']}: J1 に A-ICU は割当不可能です")
-
-    # 特例や可否
-    for _, r in prefs_df[prefs_df["priority"] == "A"].iterrows():
-        d, nm, k = r["date"], r["name"], str(r["kind"]).lower()
-        if d not in all_days or nm not in name_to_idx:
-            continue
-        di = all_days.index(d)
-        DAY = DAY_template
-        if k == "early" and DAY[di]["req"]["ER_Early"] == 0:
-            issues.append(f"{d} {nm}: 特例で早番が停止中のため A-early は不可能です")
-        if k == "late" and DAY[di]["req"]["ER_Late"] == 0:
-            issues.append(f"{d} {nm}: 特例で遅番が停止中のため A-late は不可能です")
-        if k == "day1" and DAY[di]["req"]["ER_Day1"] == 0:
-            issues.append(f"{d} {nm}: 特例で日勤1が停止中のため A-day1 は不可能です")
-        if k == "day2" and not DAY[di]["allow_d2"]:
-            issues.append(f"{d} {nm}: その日は日勤2が立たないため A-day2 は不可能です")
-        if k == "icu" and not DAY[di]["allow_icu"]:
-            issues.append(f"{d} {nm}: その日はICU不可のため A-ICU は不可能です")
+    j1_names = {names[i] for i in J1_idx}
+    for d, nm in a_df.loc[a_df["kind"].eq("icu") & a_df["name"].isin(j1_names), ["date", "name"]].itertuples(index=False, name=None):
+        issues.append(f"{d} {nm}: J1 に A-ICU は割当不可能です")
+
+    # 特例や可否（kind → その日に立っているか）を (日, kind) の bool 行列にして一括で引く
+    slot_kinds = ("early", "late", "day1", "day2", "icu")
+    open_mat = np.array(
+        [[KIND_TABLE[k][1](DAY_template[di]) for k in slot_kinds] for di in range(D)], dtype=bool
+    ).reshape(D, len(slot_kinds))
+    # kind → シフト名（枠の可否判定と定員チェックで共用）
+    slot_name = {"early": "ER_Early", "late": "ER_Late", "day1": "ER_Day1", "day2": "ER_Day2", "icu": "ICU"}
+    dated = a_df.loc[date_ok].assign(
+        di=lambda x: x["date"].map(all_days_index),
+        slot=lambda x: x["kind"].map(slot_name),
+    )
+    kind_code = dated["kind"].map({k: c for c, k in enumerate(slot_kinds)})
+    has_slot = kind_code.notna().to_numpy()  # 対象外の kind は判定しない
+    slot_open = np.zeros(len(dated), dtype=bool)
+    slot_open[has_slot] = open_mat[
+        dated["di"].to_numpy()[has_slot].astype(int), kind_code.to_numpy()[has_slot].astype(int)
+    ]
+    impossible_msg = {
+        "early": "特例で早番が停止中のため A-early は不可能です",
+        "late": "特例で遅番が停止中のため A-late は不可能です",
+        "day1": "特例で日勤1が停止中のため A-day1 は不可能です",
+        "day2": "その日は日勤2が立たないため A-day2 は不可能です",
+        "icu": "その日はICU不可のため A-ICU は不可能です",
+    }
+    blocked = valid.loc[dated.index].to_numpy() & has_slot & ~slot_open
+    for d, nm, k in dated.loc[blocked, ["date", "name", "kind"]].itertuples(index=False, name=None):
+        issues.append(f"{d} {nm}: {impossible_msg[k]}")
 
     # 同一スロットへのA過多
-    a_counts = {}
-    for _, r in prefs_df[prefs_df["priority"] == "A"].iterrows():
-        d, k = r["date"], str(r["kind"]).lower()
-        if d in all_days:
-            di = all_days.index(d)
-            key = None
-            if k == "early" and DAY_template[di]["req"]["ER_Early"] == 1:
-                key = ("ER_Early", di)
-            if k == "late" and DAY_template[di]["req"]["ER_Late"] == 1:
-                key = ("ER_Late", di)
-            if k == "day1" and DAY_template[di]["req"]["ER_Day1"] == 1:
-                key = ("ER_Day1", di)
-            if k == "day2" and DAY_template[di]["allow_d2"]:
-                key = ("ER_Day2", di)
-            if k == "icu" and DAY_template[di]["allow_icu"]:
-                key = ("ICU", di)
-            if key:
-                a_counts.setdefault(key, 0)
-                a_counts[key] += 1
-
-    for (shift_name, di), cnt in a_counts.items():
+    a_counts = dated.loc[slot_open].groupby(["di", "slot"], sort=False).size()
+    for (di, shift_name), cnt in a_counts.items():
         if cnt > 1:
             issues.append(f"{all_days[di]} {shift_name}: A希望が{cnt}件あり、定員1を超えています")
 
@@ -1341,190 +1543,248 @@ def validate_A_requests(prefs_df: pd.DataFrame, DAY_template: dict) -> list[str]
 # -------------------------
 # ソルバー本体
 # -------------------------
-def build_and_solve(
-    fair_slack: int,
-    disabled_pref_ids: set,
-    weaken_day2_bonus: bool = False,
-    repro_fix: bool = True,
-):
+# 勤務表（割当＋公平性）向けの CP-SAT パラメータ（tuned_params で差し替え可）
+# ※ PORTFOLIO_SEARCH / linearization_level=2 は単一ワーカー（再現性固定）で大幅に遅くなるため入れない
+SOLVER_TUNED_PARAMS = {
+    "repair_hint": True,
+    "use_erwa_heuristic": True,
+    "diversify_lns_params": True,
+}
+
+def _xsum(terms) -> cp_model.LinearExpr:
+    """x のスライス（object 配列）や項のリストを LinearExpr.Sum 1回でまとめる（Python の + を繰り返さない）"""
+    return cp_model.LinearExpr.Sum(terms.ravel().tolist() if isinstance(terms, np.ndarray) else list(terms))
+
+
+def build_base_model(pins: pd.DataFrame | None = None):
+    """希望・重みに依存しないハード制約だけのモデル。戻り値: (model, x, 固定割当のある人indexの集合)"""
     model = cp_model.CpModel()
 
-    # 便利なインデックス（SHIFTS は Part 1 で定義済み）
-    E_IDX   = SHIFTS.index("ER_Early")
-    D1_IDX  = SHIFTS.index("ER_Day1")
-    D2_IDX  = SHIFTS.index("ER_Day2")
-    D3_IDX  = SHIFTS.index("ER_Day3")
-    L_IDX   = SHIFTS.index("ER_Late")
-    ICU_IDX = SHIFTS.index("ICU")
-    VAC_IDX = SHIFTS.index("VAC")
-
-    # 変数: x[d, s, i] ∈ {0,1}
-    x = {
-        (d, s, i): model.NewBoolVar(f"x_d{d}_s{s}_i{i}")
-        for d in range(D) for s in range(len(SHIFTS)) for i in range(N)
-    }
+    # 変数: x[d, s, i] ∈ {0,1}（(日, シフト, 人) の object 配列。タプルキーの dict は使わない）
+    x = np.empty((D, len(SHIFTS), N), dtype=object)
+    for d in range(D):
+        for s in SHIFT_RANGE:
+            for i in range(N):
+                x[d, s, i] = model.NewBoolVar(f"x_d{d}_s{s}_i{i}")
 
-    # 1日1人1枠まで
+    # 1日1人1枠まで（線形和ではなく Bool の基数制約として渡す）
     for d in range(D):
         for i in range(N):
-            model.Add(sum(x[(d, s, i)] for s in range(len(SHIFTS))) <= 1)
+            model.AddAtMostOne(x[d, :, i].tolist())
 
     # J1 は ICU 不可
-    for d in range(D):
-        for i in [j for j in range(N) if staff_df.iloc[j]["grade"] == "J1"]:
-            model.Add(x[(d, ICU_IDX, i)] == 0)
+    for i in J1_idx:
+        model.AddBoolAnd([v.Not() for v in x[:, ICU_IDX, i]])
 
-    # 最大連勤
-    for i in range(N):
-        y = [model.NewBoolVar(f"y_d{d}_i{i}") for d in range(D)]
-        for d in range(D):
-            model.Add(y[d] == sum(x[(d, s, i)] for s in range(len(SHIFTS))))
-        window = max_consecutive + 1
-        if D >= window:
+    # 最大連勤（月内に窓が収まらなければ制約なし）
+    window = max_consecutive + 1
+    if D >= window:
+        for i in range(N):
+            # 累積和 cs[d] = (0〜d-1日目の勤務日数) にして、各窓を2項の差で表す。
+            # 1日1枠なので日ごとの勤務有無は x[d, :, i] の和そのもの（中間の Bool 変数は作らない）
+            cs = [model.NewIntVar(0, D, f"cs_d{d}_i{i}") for d in range(D + 1)]
+            model.Add(cs[0] == 0)
+            for d in range(D):
+                model.Add(cs[d + 1] == cs[d] + _xsum(x[d, :, i]))
             for start in range(0, D - window + 1):
-                model.Add(sum(y[start + k] for k in range(window)) <= max_consecutive)
+                model.Add(cs[start + window] - cs[start] <= max_consecutive)
 
     # 個々の総勤務回数（= per_person_total）
     for i in range(N):
         ti = model.NewIntVar(0, 5 * D, f"total_i{i}")
-        model.Add(ti == sum(x[(d, s, i)] for d in range(D) for s in range(len(SHIFTS))))
+        model.Add(ti == _xsum(x[:, :, i]))
         model.Add(ti == int(per_person_total))
 
-    # 日ごとの枠・可否（特例と休日設定を反映）
-    DAY = {
-        d: {"req": {"ER_Early": 1, "ER_Day1": 1, "ER_Late": 1}, "allow_d2": False, "allow_d3": False, "allow_icu": False, "drop": None}
-        for d in range(D)
-    }
-    DAY2_FORBID_LOCAL = set([d for d in all_days if d.weekday() >= 5]) | set(holidays) | set(closed_days)
-    ICU_ALLOWED_DAYS_LOCAL = set(all_days) if allow_weekend_icu else set([d for d in all_days if d.weekday() < 5])
-
-    for d, day in enumerate(all_days):
-        drop = special_map.get(day)
-        if drop in ER_BASE:
-            DAY[d]["req"][drop] = 0
-            DAY[d]["drop"] = drop
-        if day.weekday() < 5 and day not in DAY2_FORBID_LOCAL:
-            DAY[d]["allow_d2"] = True
-            DAY[d]["allow_d3"] = bool(allow_day3)
-        if day in ICU_ALLOWED_DAYS_LOCAL:
-            DAY[d]["allow_icu"] = True
-
-    # ER 基本枠（早/日1/遅）の充足
+    # ER 基本枠（早/日1/遅）の充足。止めた枠は線形和を作らず全員分の否定リテラルで固定する
+    req_arr = DAY_META["REQ"]
     for d in range(D):
-        for base in ER_BASE:
-            sidx = SHIFTS.index(base)
-            model.Add(sum(x[(d, sidx, i)] for i in range(N)) == DAY[d]["req"][base])
+        for base, sidx in ER_BASE_IDX:
+            if req_arr[base][d]:
+                model.AddExactlyOne(x[d, sidx, :].tolist())
+            else:
+                model.AddBoolAnd([v.Not() for v in x[d, sidx, :]])
 
     # D2/D3/ICU は可の日のみ 0/1
+    allow_d2, allow_d3, allow_icu = (DAY_META["ALLOW"][k] for k in ("allow_d2", "allow_d3", "allow_icu"))
     for d in range(D):
-        model.Add(sum(x[(d, D2_IDX, i)] for i in range(N)) <= (1 if DAY[d]["allow_d2"] else 0))
-        model.Add(sum(x[(d, D3_IDX, i)] for i in range(N)) <= (1 if DAY[d]["allow_d3"] else 0))
-        model.Add(sum(x[(d, ICU_IDX, i)] for i in range(N)) <= (1 if DAY[d]["allow_icu"] else 0))
+        for sidx, ok in ((D2_IDX, allow_d2[d]), (D3_IDX, allow_d3[d]), (ICU_IDX, allow_icu[d])):
+            if ok:
+                model.AddAtMostOne(x[d, sidx, :].tolist())
+            else:
+                model.AddBoolAnd([v.Not() for v in x[d, sidx, :]])
 
     # Day1 が立っている日だけ Day2/Day3 を許可（連動制約）
     for d in range(D):
-        total_d1 = sum(x[(d, D1_IDX, i)] for i in range(N))
-        model.Add(sum(x[(d, D2_IDX, i)] for i in range(N)) <= total_d1)
-        model.Add(sum(x[(d, D3_IDX, i)] for i in range(N)) <= total_d1)
+        total_d1 = _xsum(x[d, D1_IDX, :])
+        model.Add(_xsum(x[d, D2_IDX, :]) <= total_d1)
+        model.Add(_xsum(x[d, D3_IDX, :]) <= total_d1)
 
     # 週末ICUの総量/個人上限
     if allow_weekend_icu:
-        weekend_days = [d for d, day in enumerate(all_days) if day.weekday() >= 5]
-        model.Add(sum(x[(d, ICU_IDX, i)] for d in weekend_days for i in range(N)) <= int(max_weekend_icu_total))
+        weekend_days = np.flatnonzero(DAY_META["WD"] >= 5).tolist()
+        model.Add(_xsum(x[weekend_days, ICU_IDX, :]) <= int(max_weekend_icu_total))
         for i in range(N):
-            model.Add(sum(x[(d, ICU_IDX, i)] for d in weekend_days) <= int(max_weekend_icu_per_person))
+            model.Add(_xsum(x[weekend_days, ICU_IDX, i]) <= int(max_weekend_icu_per_person))
 
     # プリアサイン（固定）
-    pins_df = st.session_state.get("pins", pd.DataFrame(columns=["date", "name", "shift"]))
-    for _, row in pins_df.iterrows():
-        d = all_days.index(row["date"]) if row["date"] in all_days else None
+    pins_df = pins if pins is not None else st.session_state.get("pins", _EMPTY_PINS)
+    pinned = set()
+    for pdate, pname, sname in pins_df.reindex(columns=["date", "name", "shift"]).itertuples(index=False, name=None):
+        d = all_days_index.get(pdate)
         if d is None:
             continue
-        sname = row.get("shift")
         if sname not in SHIFTS:
             continue
-        sidx = SHIFTS.index(sname)
-        i = name_to_idx.get(row.get("name"))
+        sidx = SHIFT_IDX[sname]
+        i = name_to_idx.get(pname)
         if i is None:
             continue
-        model.Add(x[(d, sidx, i)] == 1)
+        model.Add(x[d, sidx, i] == 1)
+        pinned.add(i)
+
+    return model, x, frozenset(pinned)
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _cached_base_model(key: tuple, _pins_df: pd.DataFrame):
+    """key（構造入力）が同じ間は build_base_model の結果を使い回す。呼び出し側は必ず Clone して使う"""
+    return build_base_model(_pins_df)
+
+
+def get_base_model(pins: pd.DataFrame | None = None):
+    """ウェイト/希望だけ変えた再実行ではハード制約モデルを作り直さない（戻り値は build_base_model と同じ）"""
+    pins_df = pins if pins is not None else st.session_state.get("pins", _EMPTY_PINS)
+    pins_key = tuple(pins_df.reindex(columns=["date", "name", "shift"]).itertuples(index=False, name=None))
+    key = (
+        tuple(all_days), tuple(names), tuple(J1_idx),
+        tuple(holidays), tuple(closed_days), tuple(special_map.items()),
+        bool(allow_day3), bool(allow_weekend_icu),
+        int(max_consecutive), int(per_person_total),
+        int(max_weekend_icu_total), int(max_weekend_icu_per_person),
+        pins_key,
+    )
+    return _cached_base_model(key, pins_df)
+
+
+def build_and_solve(
+    prefs: pd.DataFrame,
+    fair_slack: int,
+    disabled_pref_ids: set,
+    weaken_day2_bonus: bool = False,
+    repro_fix: bool = True,
+    tuned_params: dict | None = None,
+    hint: np.ndarray | None = None,
+    track_a: bool = False,
+    time_limit: float = 20.0,
+    pins: pd.DataFrame | None = None,
+    base: tuple | None = None,
+    feasibility_only: bool = False,
+    priority_overrides: dict | None = None,
+):
+    # ハード制約部分は build_base_model で作り、Clone したモデルに希望・目的関数を足す
+    base_model, base_x, pinned = base if base is not None else get_base_model(pins)
+    model = base_model.Clone()
+    x = np.empty(base_x.shape, dtype=object)
+    for k, v in enumerate(base_x.flat):
+        x.flat[k] = model.GetBoolVarFromProtoIndex(v.Index())
+
+    # 日ごとの枠・可否（特例と休日設定を反映 / 事前計算済み）
+    DAY = DAY_META["DAY"]
+
+    # 前回解からのウォームスタート（x と同形の 0/1 配列。矛盾する分は repair_hint で修復）
+    use_hint = hint is not None and hint.shape == x.shape
+    if use_hint:
+        for v, h in zip(x.flat, hint.flat):
+            model.AddHint(v, int(h))
 
     # 希望（A/B/C）
-    prefs_eff = st.session_state.prefs.copy()
-    prefs_eff["kind"] = prefs_eff["kind"].astype(str).str.strip().str.lower()
-    prefs_eff["priority"] = prefs_eff["priority"].astype(str).str.strip().str.upper()
+    # 引数で受け取る（保存/読込時に _normalize_prefs で正規化済み）
+    prefs_eff = prefs
+
+    # 当月・既知の名前の行だけを (行番号, 日index, 人index, kind, priority) に一括で変換
+    prefs_r = prefs_eff.reset_index(drop=True)
+    d_col = prefs_r["date"].map(all_days_index)
+    i_col = prefs_r["name"].map(name_to_idx)
+    in_scope = (d_col.notna() & i_col.notna()).to_numpy()
+    # 行番号→優先度の上書き（ブロッキングA判定で1件だけ外す試行用。DF全体は複製しない）
+    pr_col = prefs_r["priority"]
+    if priority_overrides:
+        pr_col = pr_col.copy()
+        pr_col[list(priority_overrides)] = list(priority_overrides.values())
+    # kind/priority は正規化済みの値をそのまま使う（A/B/C 振り分けと年休判定で同じ値を見る）
+    kind_in = prefs_r.loc[in_scope, "kind"]
+    pr_in = pr_col[in_scope]
+    pref_rows = list(zip(
+        np.flatnonzero(in_scope).tolist(),
+        d_col[in_scope].astype(int).tolist(),
+        i_col[in_scope].astype(int).tolist(),
+        kind_in.tolist(),
+        pr_in.tolist(),
+    ))
 
     # --- Vacation（年休）を許可する (d,i) の集合 ---
-    allow_vac = set()
-    for _, row in prefs_eff.iterrows():
-        try:
-            kind = str(row["kind"]).lower().strip()
-            pr   = str(row["priority"]).upper().strip()
-            dte  = row["date"]
-            nm   = row["name"]
-        except Exception:
-            continue
-        if kind == "vacation" and pr in ("A", "B", "C"):
-            if dte in all_days and nm in name_to_idx:
-                d = all_days.index(dte)
-                i = name_to_idx[nm]
-                allow_vac.add((d, i))
+    vac = (kind_in.eq("vacation") & pr_in.isin(("A", "B", "C"))).to_numpy()
+    allow_vac = {(d, i) for (_, d, i, _, _), v in zip(pref_rows, vac) if v}
 
     # 許可されていない (d,i) は VAC=0
     for d in range(D):
         for i in range(N):
             if (d, i) not in allow_vac:
-                model.Add(x[(d, VAC_IDX, i)] == 0)
+                model.Add(x[d, VAC_IDX, i] == 0)
 
     # Aは基本的にハード制約化、B/Cは目的関数でペナルティ
     pref_soft = []        # (rid, d, i, kind, pr)  … B/C or 落としたAの代替
     A_star = set()        # (d, shift_name, name)
     A_off  = defaultdict(list)
 
-    for rid, row in prefs_eff.reset_index(drop=True).iterrows():
-        if row["date"] not in all_days or row["name"] not in name_to_idx:
-            continue
-        d = all_days.index(row["date"])
-        i = name_to_idx[row["name"]]
-        kind = row["kind"]
-        pr = row["priority"]
+    # track_a=True のとき A制約を仮定リテラルで有効化し、不可能時に原因Aを取り出せるようにする
+    a_lits = {}
+
+    def _hard_a(rid, ct):
+        if track_a:
+            ct.OnlyEnforceIf(a_lits.setdefault(rid, model.NewBoolVar(f"a_lit{rid}")))
+
+    has_pref = set()      # 当月に希望（優先度・有効無効を問わず）のある人index
+    for rid, d, i, kind, pr in pref_rows:
+        has_pref.add(i)
+        nm = names[i]
 
         # day/icu の A は B に降格（UI側でもやっているが二重防御）
-        if pr == "A" and kind in ("day", "icu"):
+        if pr == "A" and kind in DAY_ICU_DOWNGRADE:
             pr = "B"
 
         if pr == "A":
             if kind == "off":
-                model.Add(sum(x[(d, s, i)] for s in range(len(SHIFTS))) == 0)
-                A_off[d].append(row["name"])
+                _hard_a(rid, model.AddBoolAnd([v.Not() for v in x[d, :, i]]))
+                A_off[d].append(nm)
             elif kind == "early":
                 if DAY[d]["req"]["ER_Early"] == 1:
-                    model.Add(x[(d, E_IDX, i)] == 1)
-                    A_star.add((d, "ER_Early", row["name"]))
+                    _hard_a(rid, model.Add(x[d, E_IDX, i] == 1))
+                    A_star.add((d, "ER_Early", nm))
                 else:
                     pref_soft.append((rid, d, i, "early", "B"))
             elif kind == "late":
                 if DAY[d]["req"]["ER_Late"] == 1:
-                    model.Add(x[(d, L_IDX, i)] == 1)
-                    A_star.add((d, "ER_Late", row["name"]))
+                    _hard_a(rid, model.Add(x[d, L_IDX, i] == 1))
+                    A_star.add((d, "ER_Late", nm))
                 else:
                     pref_soft.append((rid, d, i, "late", "B"))
             elif kind == "day1":
                 if DAY[d]["req"]["ER_Day1"] == 1:
-                    model.Add(x[(d, D1_IDX, i)] == 1)
-                    A_star.add((d, "ER_Day1", row["name"]))
+                    _hard_a(rid, model.Add(x[d, D1_IDX, i] == 1))
+                    A_star.add((d, "ER_Day1", nm))
                 else:
                     pref_soft.append((rid, d, i, "day1", "B"))
             elif kind == "day2":
                 if DAY[d]["allow_d2"]:
-                    model.Add(x[(d, D2_IDX, i)] == 1)
-                    A_star.add((d, "ER_Day2", row["name"]))
+                    _hard_a(rid, model.Add(x[d, D2_IDX, i] == 1))
+                    A_star.add((d, "ER_Day2", nm))
                 else:
                     pref_soft.append((rid, d, i, "day2", "B"))
             elif kind == "vacation":
                 # 事前に allow_vac に入っているため、ここは単純に 1 固定でOK
-                model.Add(x[(d, VAC_IDX, i)] == 1)
-                A_star.add((d, "VAC", row["name"]))
+                _hard_a(rid, model.Add(x[d, VAC_IDX, i] == 1))
+                A_star.add((d, "VAC", nm))
             else:
                 pref_soft.append((rid, d, i, kind, "B"))
         else:
@@ -1532,51 +1792,61 @@ def build_and_solve(
                 continue
             pref_soft.append((rid, d, i, kind, pr))
 
-    # 休日回数のバランス（J1）
-    hol = []
-    Hd = [idx for idx, day in enumerate(all_days) if (day.weekday() >= 5 or day in holidays)]
+    if a_lits:
+        model.AddAssumptions(list(a_lits.values()))
+
+    # 対称性の除去: 同区分・同ICU希望比率で希望も固定割当もないスタッフは互いに入れ替えても
+    # 制約・目的値が変わらないので、勤務日の重み付き和（1日目=1…）が index 順に非減少となる解だけを探す
+    grade_arr = staff_df["grade"].to_numpy()
+    desired_icu = staff_df["desired_icu_ratio"].to_numpy(dtype=np.float64)
+    interchangeable = defaultdict(list)
     for i in range(N):
-        hi = model.NewIntVar(0, 5 * D, f"hol_i{i}")
-        model.Add(hi == sum(x[(d, s, i)] for d in Hd for s in range(len(SHIFTS))))
-        hol.append(hi)
+        if i not in has_pref and i not in pinned:
+            interchangeable[(grade_arr[i], desired_icu[i])].append(i)
+    day_w = np.repeat(np.arange(1, D + 1), len(SHIFTS)).tolist()   # x[:, :, i].ravel() と同じ並び
+    for members in interchangeable.values():
+        for a, b in zip(members, members[1:]):
+            model.Add(
+                cp_model.LinearExpr.WeightedSum(x[:, :, a].ravel().tolist(), day_w)
+                <= cp_model.LinearExpr.WeightedSum(x[:, :, b].ravel().tolist(), day_w)
+            )
 
-    for a in J1_idx:
-        for b in J1_idx:
-            if a >= b:
-                continue
-            diff = model.NewIntVar(-5 * D, 5 * D, f"j1diff_{a}_{b}")
-            model.Add(diff == hol[a] - hol[b])
-            model.Add(diff <= fair_slack)
-            model.Add(-diff <= fair_slack)
+    # 休日回数のバランス（J1）
+    # J1 が2人未満、または slack が休日数以上なら公平性制約は常に満たされるので作らない
+    Hd = np.flatnonzero(DAY_META["IS_HOL"]).tolist()   # H = 土日 ∪ 祝日
+    j1_fair = len(J1_idx) >= 2
+    hol_fair = j1_fair and fair_slack < len(Hd)
+    hol_j1j2 = len(J1_idx) > 0 and len(J2_idx) > 0
+    # 人別の回数は IntVar を作らず、x の和（線形式）をそのまま上下限の制約に使う
+    hol = {}
+    if hol_fair or hol_j1j2:
+        hol = {i: _xsum(x[Hd, :, i]) for i in range(N)}
+
+    # J1 内の最大−最小 ≦ slack（全ペアの差を張る代わりに上下の包絡変数2本で表す）
+    def _limit_j1_spread(arr, ub, slack, tag):
+        hi_v = model.NewIntVar(0, ub, f"{tag}_hi")
+        lo_v = model.NewIntVar(0, ub, f"{tag}_lo")
+        for a in J1_idx:
+            model.Add(hi_v >= arr[a])
+            model.Add(lo_v <= arr[a])
+        model.Add(hi_v - lo_v <= slack)
+
+    if hol_fair:
+        _limit_j1_spread(hol, 5 * D, fair_slack, "j1hol")
 
     # J1 ≧ J2 の休日（上限的に）
-    if len(J1_idx) > 0 and len(J2_idx) > 0:
+    if hol_j1j2:
         j1max = model.NewIntVar(0, 5 * D, "j1max_hol")
         for a in J1_idx:
             model.Add(j1max >= hol[a])
         for j in J2_idx:
             model.Add(hol[j] <= j1max)
 
-    # J1 内の早/遅/日勤(1+2)の偏り±2
-    early_cnt, late_cnt, day12_cnt = [], [], []
-    for i in range(N):
-        ei = model.NewIntVar(0, D, f"early_i{i}")
-        li = model.NewIntVar(0, D, f"late_i{i}")
-        di = model.NewIntVar(0, 2 * D, f"day12_i{i}")
-        model.Add(ei == sum(x[(d, E_IDX, i)] for d in range(D)))
-        model.Add(li == sum(x[(d, L_IDX, i)] for d in range(D)))
-        model.Add(di == sum(x[(d, D1_IDX, i)] + x[(d, D2_IDX, i)] for d in range(D)))
-        early_cnt.append(ei); late_cnt.append(li); day12_cnt.append(di)
-
-    for a in J1_idx:
-        for b in J1_idx:
-            if a >= b:
-                continue
-            for arr in (early_cnt, late_cnt, day12_cnt):
-                df = model.NewIntVar(-2 * D, 2 * D, "tmp")
-                model.Add(df == arr[a] - arr[b])
-                model.Add(df <= 2)
-                model.Add(-df <= 2)
+    # J1 内の早/遅/日勤(1+2)の偏り±2（カウンタは J1 の分だけ作る）
+    if j1_fair:
+        _limit_j1_spread({i: _xsum(x[:, E_IDX, i]) for i in J1_idx}, D, 2, "j1early")
+        _limit_j1_spread({i: _xsum(x[:, L_IDX, i]) for i in J1_idx}, D, 2, "j1late")
+        _limit_j1_spread({i: _xsum(x[:, [D1_IDX, D2_IDX], i]) for i in J1_idx}, 2 * D, 2, "j1day12")
 
     # 目的関数（未充足ペナルティ／疲労／D2・D3配置ボーナス／ICU比率）
     terms = []
@@ -1584,112 +1854,94 @@ def build_and_solve(
     # B/C 希望ペナルティ
     for rid, d, i, kind, pr in pref_soft:
         w = weight_pref_B if pr == "B" else weight_pref_C
-        if w <= 0:
+        if int(100 * w) <= 0:
             continue
-        assigned_any = model.NewBoolVar(f"assign_any_d{d}_i{i}")
-        model.Add(assigned_any == sum(x[(d, s, i)] for s in range(len(SHIFTS))))
         if kind == "off":
-            terms.append(int(100 * w) * assigned_any)  # 出勤してしまったらペナルティ
-        elif kind == "early" and DAY[d]["req"]["ER_Early"] == 1:
-            correct = x[(d, E_IDX, i)]
-            miss = model.NewBoolVar(f"pref_early_miss_d{d}_i{i}")
-            model.Add(miss + correct == 1)
-            terms.append(int(100 * w) * miss)
-        elif kind == "late" and DAY[d]["req"]["ER_Late"] == 1:
-            correct = x[(d, L_IDX, i)]
-            miss = model.NewBoolVar(f"pref_late_miss_d{d}_i{i}")
-            model.Add(miss + correct == 1)
-            terms.append(int(100 * w) * miss)
-        elif kind == "day1" and DAY[d]["req"]["ER_Day1"] == 1:
-            correct = x[(d, D1_IDX, i)]
-            miss = model.NewBoolVar(f"pref_day1_miss_d{d}_i{i}")
-            model.Add(miss + correct == 1)
-            terms.append(int(100 * w) * miss)
-        elif kind == "day2" and DAY[d]["allow_d2"]:
-            correct = x[(d, D2_IDX, i)]
-            miss = model.NewBoolVar(f"pref_day2_miss_d{d}_i{i}")
-            model.Add(miss + correct == 1)
-            terms.append(int(100 * w) * miss)
+            # 出勤してしまったらペナルティ（1日1枠なので x[d, :, i] の和がそのまま 0/1 の出勤フラグ）
+            terms.append(int(100 * w) * _xsum(x[d, :, i]))
         elif kind == "day":
             day1_ok = (DAY[d]["req"]["ER_Day1"] == 1)
             day2_ok = DAY[d]["allow_d2"]
             if day1_ok or day2_ok:
                 cands = []
-                if day1_ok: cands.append(x[(d, D1_IDX, i)])
-                if day2_ok: cands.append(x[(d, D2_IDX, i)])
-                correct = model.NewBoolVar(f"pref_day_any_ok_d{d}_i{i}")
-                model.AddMaxEquality(correct, cands)
-                miss = model.NewBoolVar(f"pref_day_miss_d{d}_i{i}")
-                model.Add(miss + correct == 1)
-                terms.append(int(100 * w) * miss)
-        elif kind == "icu" and (i in J2_idx) and DAY[d]["allow_icu"]:
-            correct = x[(d, ICU_IDX, i)]
-            miss = model.NewBoolVar(f"pref_icu_miss_d{d}_i{i}")
-            model.Add(miss + correct == 1)
-            terms.append(int(100 * w) * miss)
-        elif kind == "vacation":
-            correct = x[(d, VAC_IDX, i)]
-            miss = model.NewBoolVar(f"pref_vac_miss_d{d}_i{i}")
-            model.Add(miss + correct == 1)
-            terms.append(int(100 * w) * miss)
+                if day1_ok: cands.append(x[d, D1_IDX, i])
+                if day2_ok: cands.append(x[d, D2_IDX, i])
+                # 日勤1/日勤2 は同じ人の同じ日に両立しないので、和がそのまま「どちらかに入った」
+                terms.append(int(100 * w) * (1 - _xsum(cands)))
+        elif kind in KIND_TABLE:
+            sidx, slot_open = KIND_TABLE[kind]
+            if not slot_open(DAY[d]) or (sidx == ICU_IDX and i not in J2_set):
+                continue
+            terms.append(int(100 * w) * (1 - x[d, sidx, i]))   # 外れたら（= 1 - 割当）ペナルティ
 
     # 疲労（遅番→翌早番）
-    if enable_fatigue and weight_fatigue > 0:
+    # 最小化で係数が正なので f は下限まで下がる（f ≦ 各項 の上側の制約は不要）。
+    # 遅番か翌日の早番が止まっている日は起こり得ないので作らない
+    if enable_fatigue and int(100 * weight_fatigue) > 0:
+        req_late, req_early = DAY_META["REQ"]["ER_Late"], DAY_META["REQ"]["ER_Early"]
+        fat_days = [d for d in range(D - 1) if req_late[d] and req_early[d + 1]]
         for i in range(N):
-            for d in range(D - 1):
+            for d in fat_days:
                 f = model.NewBoolVar(f"fatigue_d{d}_i{i}")
-                model.Add(f >= x[(d, L_IDX, i)] + x[(d + 1, E_IDX, i)] - 1)
-                model.Add(f <= x[(d, L_IDX, i)])
-                model.Add(f <= x[(d + 1, E_IDX, i)])
+                model.Add(f >= x[d, L_IDX, i] + x[d + 1, E_IDX, i] - 1)
                 terms.append(int(100 * weight_fatigue) * f)
 
     # Day2/Day3 の配置ボーナス（置ける日なのに置かなかったら損）
-    for d, day in enumerate(all_days):
+    # 重みが0の日は補助変数自体を作らない（placed の定義は枠≦1 の制約と重複するだけ）
+    is_wed = DAY_META["WD"] == 2
+    for d in range(D):
         if DAY[d]["allow_d2"]:
-            placed = model.NewBoolVar(f"d2_placed_{d}")
-            model.Add(placed == sum(x[(d, D2_IDX, i)] for i in range(N)))
-            w = weight_day2_weekday + (weight_day2_wed_bonus if day.weekday() == 2 else 0.0)
+            w = weight_day2_weekday + (weight_day2_wed_bonus if is_wed[d] else 0.0)
             if weaken_day2_bonus:
                 w = max(0.0, w * 0.5)
-            if w > 0:
+            if int(100 * w) > 0:
+                placed = model.NewBoolVar(f"d2_placed_{d}")
+                model.Add(placed == _xsum(x[d, D2_IDX, :]))
                 terms.append(int(100 * w) * (1 - placed))
         if DAY[d]["allow_d3"]:
-            placed3 = model.NewBoolVar(f"d3_placed_{d}")
-            model.Add(placed3 == sum(x[(d, D3_IDX, i)] for i in range(N)))
-            w3 = weight_day3_weekday + (weight_day3_wed_bonus if day.weekday() == 2 else 0.0)
+            w3 = weight_day3_weekday + (weight_day3_wed_bonus if is_wed[d] else 0.0)
             if weaken_day2_bonus:
                 w3 = max(0.0, w3 * 0.5)
-            if w3 > 0:
+            if int(100 * w3) > 0:
+                placed3 = model.NewBoolVar(f"d3_placed_{d}")
+                model.Add(placed3 == _xsum(x[d, D3_IDX, :]))
                 terms.append(int(100 * w3) * (1 - placed3))
 
-    # ICU 希望比率の偏差
-    if weight_icu_ratio > 0 and len(J2_idx) > 0:
+    # ICU 希望比率の偏差（係数は int(weight) なので 1 未満なら何も作らない）
+    if int(weight_icu_ratio) > 0 and len(J2_idx) > 0:
         scale = 100
         for j in J2_idx:
-            ICU_j = model.NewIntVar(0, 5 * D, f"ICU_j{j}")
-            model.Add(ICU_j == sum(x[(d, ICU_IDX, j)] for d in range(D)))
-            target_scaled = model.NewIntVar(0, scale * 5 * D, f"icu_target_j{j}")
-            desired = float(staff_df.iloc[j]["desired_icu_ratio"])
-            model.Add(target_scaled == int(round(desired * scale)) * int(per_person_total))
-            ICU_scaled = model.NewIntVar(0, scale * 5 * D, f"icu_scaled_j{j}")
-            model.Add(ICU_scaled == scale * ICU_j)
-            diff = model.NewIntVar(-scale * 5 * D, scale * 5 * D, f"icu_diff_j{j}")
-            model.Add(diff == ICU_scaled - target_scaled)
+            # 目標は定数なので、|scale·ICU回数 − 目標| を中間変数なしで1本の絶対値制約にする
+            target_scaled = int(round(desired_icu[j] * scale)) * int(per_person_total)
             dev = model.NewIntVar(0, scale * 5 * D, f"icu_dev_j{j}")
-            model.AddAbsEquality(dev, diff)
+            model.AddAbsEquality(dev, scale * _xsum(x[:, ICU_IDX, j]) - target_scaled)
             terms.append(int(weight_icu_ratio) * dev)
 
-    model.Minimize(sum(terms))
+    model.Minimize(_xsum(terms))
 
     # ---- Solve ----
     solver = cp_model.CpSolver()
-    solver.parameters.max_time_in_seconds = 20.0
-    solver.parameters.num_search_workers = 1 if (fix_repro and repro_fix) else 8
+    solver.parameters.max_time_in_seconds = float(time_limit)
+    # 再現性固定時は1ワーカー（並列ポートフォリオは非決定的）。それ以外はコア数に合わせて最低8ワーカー
+    solver.parameters.num_search_workers = 1 if (fix_repro and repro_fix) else max(8, os.cpu_count() or 1)
+    solver.parameters.log_search_progress = False
+    solver.parameters.cp_model_presolve = True
+    solver.parameters.linearization_level = int(solver_linearization)
+    solver.parameters.symmetry_level = int(solver_symmetry)
+    solver.parameters.optimize_with_core = bool(solver_core)
+    for k, v in (SOLVER_TUNED_PARAMS if tuned_params is None else tuned_params).items():
+        setattr(solver.parameters, k, v)
+    if use_hint:
+        solver.parameters.repair_hint = True
     if fix_repro and repro_fix:
         try:
             solver.parameters.random_seed = int(seed_val)
         except Exception:
             pass
+    # 可否だけ分かればよい呼び出し（ブロッキングA判定）は最初の解で打ち切り、時間も短く区切る
+    if feasibility_only:
+        solver.parameters.max_time_in_seconds = min(float(time_limit), 5.0)
+        solver.parameters.stop_after_first_solution = True
 
     status = solver.Solve(model)
     status_map = {
@@ -1699,9 +1951,20 @@ def build_and_solve(
         cp_model.MODEL_INVALID: "MODEL_INVALID",
         cp_model.UNKNOWN: "UNKNOWN",
     }
-    artifacts = {"x": x, "DAY": DAY, "A_star": A_star, "A_off": A_off}
+    artifacts = {"x": x, "DAY": DAY, "A_star": A_star, "A_off": A_off, "a_lits": a_lits}
     return status_map.get(status, "UNKNOWN"), solver, artifacts
 
+# -------------------------
+# 前回解（ウォームスタート用）
+# -------------------------
+def _last_solution_key():
+    return (year, month, tuple(names))
+
+def _last_solution_hint():
+    """同じ年月・同じスタッフ構成の前回解（(日, シフト, 人) の 0/1 配列）。無ければ None"""
+    last = st.session_state.get("last_solution")
+    return last[1] if last is not None and last[0] == _last_solution_key() else None
+
 # -------------------------
 # infeasible 時のブロッキングA特定（1件ずつ）
 # -------------------------
@@ -1709,20 +1972,59 @@ def find_blocking_A_once(fair_slack_base: int, weaken_base: bool):
     """Aレコードを1件ずつ無効化して解けるか検査。戻り値: list[(rid, row_dict)]"""
     prefs_base = st.session_state.prefs.reset_index(drop=True)
     A_only = prefs_base[prefs_base["priority"] == "A"].copy()
-    blockers = []
-    for rid, row in A_only.iterrows():
-        tmp = prefs_base.copy()
-        tmp.loc[rid, "priority"] = "Z"  # 一時的に無効化
-        bak = st.session_state.prefs
-        st.session_state.prefs = tmp
-        s, sol, a = build_and_solve(
-            fair_slack=fair_slack_base, disabled_pref_ids=set(),
-            weaken_day2_bonus=weaken_base
+
+    # まず全A入りで1回だけ解き、不可能なら原因候補（仮定の部分集合）に絞る。
+    # 単独で外して解けるAは必ずこの部分集合に含まれるので、候補外は試さなくてよい。
+    # 絞り込み用なので時間は短く区切り、打ち切り（UNKNOWN）なら全Aを従来どおり試す
+    # ハード制約部分のモデルは1回だけ作り、以降の試行はそれを Clone して使う
+    # （スレッド内では st.session_state を読めないため pins は先に取り出して渡す）
+    pins = st.session_state.get("pins", _EMPTY_PINS)
+    base = get_base_model(pins)
+    # 各試行は A を1件外すだけなので、前回の勤務表があれば初期解のヒントとして全試行で共有する
+    hint = _last_solution_hint()
+    s, sol, a = build_and_solve(
+        prefs_base, fair_slack=fair_slack_base, disabled_pref_ids=set(),
+        weaken_day2_bonus=weaken_base, track_a=True, base=base, feasibility_only=True
+    )
+    if s in ("OPTIMAL", "FEASIBLE"):
+        return list(A_only.to_dict("index").items())
+    if s == "INFEASIBLE":
+        lit_to_rid = {lit.Index(): rid for rid, lit in a["a_lits"].items()}
+        core = {lit_to_rid[k] for k in sol.SufficientAssumptionsForInfeasibility() if k in lit_to_rid}
+        A_only = A_only.loc[A_only.index.isin(core)]
+
+    # 候補ごとの試行は互いに独立なのでスレッドで並列に解く（CP-SAT の Solve 中は GIL を解放する）
+    n_jobs = max(1, min(len(A_only), (os.cpu_count() or 2) // 2))
+    job_params = {**SOLVER_TUNED_PARAMS, "num_search_workers": 2} if n_jobs > 1 else None
+
+    def _feasible_without(rid):
+        # この試行だけ優先度を "Z"（無効）として扱う（prefs_base もセッション状態も触らない）
+        s, _, _ = build_and_solve(
+            prefs_base, fair_slack=fair_slack_base, disabled_pref_ids=set(),
+            weaken_day2_bonus=weaken_base, tuned_params=job_params, base=base, hint=hint,
+            feasibility_only=True, priority_overrides={rid: "Z"},
         )
-        st.session_state.prefs = bak
-        if s in ("OPTIMAL", "FEASIBLE"):
-            blockers.append((rid, row.to_dict()))
-    return blockers
+        return s in ("OPTIMAL", "FEASIBLE")
+
+    rids = A_only.index.tolist()
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+            ok = list(ex.map(_feasible_without, rids))
+    else:
+        ok = [_feasible_without(rid) for rid in rids]
+    rows = A_only.to_dict("index")
+    return [(rid, rows[rid]) for rid, f in zip(rids, ok) if f]
+
+# -------------------------
+# 解の人別集計（sol[d, s, i] の 0/1 配列から）
+# -------------------------
+def compute_person_stats(sol: np.ndarray, hol_days_idx: list[int]):
+    """(シフト別回数 (人, シフト), 休日勤務数 (人,), 遅番→翌早番の回数 (人,)) を返す"""
+    work_idx = [k for k in SHIFT_RANGE if k != VAC_IDX]                 # 年休以外の勤務
+    totals = sol.sum(axis=0, dtype=np.int64).T
+    holiday = sol[hol_days_idx][:, work_idx, :].sum(axis=(0, 1), dtype=np.int64)
+    fatigue = (sol[:-1, L_IDX, :] & sol[1:, E_IDX, :]).sum(axis=0, dtype=np.int64)
+    return totals, holiday, fatigue
 
 # ===== ここで Part 3 / 4 終了 =====
 # （続きは Part 4 へ：実行ボタン、結果表示、ダウンロード）  
@@ -1742,7 +2044,7 @@ weaken_day2_bonus = False
 fix_repro = st.checkbox(
     "再現性を固定",
     value=True,
-    help="ONにすると、下の乱数シード値を使って同じ条件で同じ勤務表を再現できます。"
+    help="ONにすると、下の乱数シード値を使って同じ条件で同じ勤務表を再現できます（1スレッドで探索）。OFFにすると並列探索で速くなる代わりに結果は毎回変わります。"
 )
 
 if fix_repro:
@@ -1754,24 +2056,36 @@ if fix_repro:
     st.caption("🔑 同じseed値であれば、同じ条件の勤務表を再現できます。")
 else:
     seed_val = None
-    st.caption("🎲 OFFにすると、毎回異なる乱数でスケジュールを生成します。")
+    st.caption("🎲 OFFにすると、毎回異なる乱数で（並列探索により高速に）スケジュールを生成します。")
 
 # =========================
 # 🚀 実行ボタン＆最適化処理（押すまで何も表示しない）
 # =========================
 
+solve_time_limit = st.slider(
+    "最適化の制限時間（秒）", min_value=5, max_value=120, value=20, step=5, key="solve_time_limit",
+    help="この時間で打ち切り、それまでに見つかった最良の勤務表を表示します。"
+)
+
 run_btn = st.button("🚀 勤務表を作成する", type="primary", use_container_width=True, key="generate_schedule")
 
 if run_btn:
     if fix_repro:
         st.caption("※ 乱数シードを固定中（同じ条件なら再現しやすくなります）")
 
-    with st.spinner("最適化中... 最大20秒ほどかかることがあります"):
+    # 同じ年月・同じスタッフ構成で前回解があれば、それを初期解のヒントにする
+    # （再現性固定中は使わない。ヒントで探索が変わると同じ seed でも結果が前回の実行に依存するため）
+    hint = None if fix_repro else _last_solution_hint()
+
+    with st.spinner(f"最適化中... 最大{solve_time_limit}秒ほどかかることがあります"):
         status, solver, artifacts = build_and_solve(
+            st.session_state.prefs,
             fair_slack=fair_slack,                     # ← ★つまみの値から自動計算済み
             disabled_pref_ids=set(),
             weaken_day2_bonus=weaken_day2_bonus,
-            repro_fix=fix_repro
+            repro_fix=fix_repro,
+            hint=hint,
+            time_limit=solve_time_limit,
         )
 
     st.write(f"**Solver status:** {status}")
@@ -1779,6 +2093,19 @@ if run_btn:
     # 可行解チェック
     if status not in ("OPTIMAL", "FEASIBLE"):
         st.error("❌ 可行解が見つかりませんでした。A希望・特例・総勤務回数の整合をご確認ください。")
+        # A希望の物理的な不可能（同日矛盾・枠が立たない日・定員超過など）を列挙
+        a_issues = validate_A_requests(st.session_state.prefs, DAY_META["DAY"])
+        if a_issues:
+            st.warning("A希望に物理的に満たせないものがあります:\n" + "\n".join(f"- {m}" for m in a_issues))
+        # 不可能が証明された場合だけ、1件外せば解けるAを特定する（打ち切り UNKNOWN では行わない）
+        if status == "INFEASIBLE":
+            with st.spinner("原因となるA希望を確認しています..."):
+                blockers = find_blocking_A_once(fair_slack, weaken_day2_bonus)
+            if blockers:
+                st.info(
+                    "次のA希望のどれか1件を外す（B/Cに下げる）と勤務表を作成できます:\n"
+                    + "\n".join(f"- {r['date']} {r['name']}（{r['kind']}）" for _, r in blockers)
+                )
         st.stop()
 
     # ---------- 成功時 ----------
@@ -1787,76 +2114,68 @@ if run_btn:
     A_star   = artifacts.get("A_star", set())
     A_off    = artifacts.get("A_off", {})     # {day_index: [names,...]}
 
+    # 解を (日, シフト, 人) の 0/1 配列として1回だけ取り出す（以降は solver.Value を呼ばない）
+    S = len(SHIFTS)
+    sol = np.fromiter((solver.Value(v) for v in x.flat), dtype=np.int8, count=D * S * N).reshape(D, S, N)
+    worked = sol.any(axis=1)                  # (日, 人) その日に何か割当があるか
+    st.session_state.last_solution = (_last_solution_key(), sol)
+
     # ===== B/C 希望の充足判定（全種別） =====
-    prefs_now = st.session_state.prefs.copy()
-    prefs_now["kind"]     = prefs_now["kind"].astype(str).str.lower()
-    prefs_now["priority"] = prefs_now["priority"].astype(str).str.upper()
-    # この月・既知の名前だけに限定
-    prefs_now = prefs_now[prefs_now["date"].isin(all_days) & prefs_now["name"].isin(name_to_idx.keys())]
-
-    # 便利なシフトindex
-    E_IDX   = SHIFTS.index("ER_Early")
-    D1_IDX  = SHIFTS.index("ER_Day1")
-    D2_IDX  = SHIFTS.index("ER_Day2")
-    L_IDX   = SHIFTS.index("ER_Late")
-    ICU_IDX = SHIFTS.index("ICU")
-    VAC_IDX = SHIFTS.index("VAC")
-
-    from collections import defaultdict
-    total_B = defaultdict(int); hit_B = defaultdict(int)
-    total_C = defaultdict(int); hit_C = defaultdict(int)
-    unmet_examples = []  # タイトルメッセージ用に、未充足の例を数件拾う
+    # この月・既知の名前だけに限定し、日index/人index を列として付与（kind/priority は正規化済み）
+    # （所属判定と index 付与を dict の map 1回ずつで兼ねる）
+    prefs_now = st.session_state.prefs
+    d_now = prefs_now["date"].map(all_days_index)
+    i_now = prefs_now["name"].map(name_to_idx)
+    keep = d_now.notna() & i_now.notna()
+    prefs_now = prefs_now[keep].assign(d=d_now[keep].astype(int), i=i_now[keep].astype(int))
 
     def _sat(d: int, i: int, kind: str) -> bool:
         """(日index d, 人index i) が kind の B/C希望を満たしているか"""
         # その日の本人の割当有無
-        assigned_any = sum(solver.Value(x[(d, s, i)]) for s in range(len(SHIFTS))) > 0
         if kind == "off":
-            return not assigned_any
+            return not worked[d, i]
 
         if kind == "early":
-            return (DAY[d]["req"]["ER_Early"] == 1) and (solver.Value(x[(d, E_IDX, i)]) == 1)
+            return (DAY[d]["req"]["ER_Early"] == 1) and (sol[d, E_IDX, i] == 1)
 
         if kind in ("day1", "day_1", "d1"):
-            return (DAY[d]["req"]["ER_Day1"] == 1) and (solver.Value(x[(d, D1_IDX, i)]) == 1)
+            return (DAY[d]["req"]["ER_Day1"] == 1) and (sol[d, D1_IDX, i] == 1)
 
         if kind in ("day2", "day_2", "d2"):
-            return DAY[d]["allow_d2"] and (solver.Value(x[(d, D2_IDX, i)]) == 1)
+            return DAY[d]["allow_d2"] and (sol[d, D2_IDX, i] == 1)
 
         if kind == "day":
-            ok1 = (DAY[d]["req"]["ER_Day1"] == 1) and (solver.Value(x[(d, D1_IDX, i)]) == 1)
-            ok2 = DAY[d]["allow_d2"] and (solver.Value(x[(d, D2_IDX, i)]) == 1)
+            ok1 = (DAY[d]["req"]["ER_Day1"] == 1) and (sol[d, D1_IDX, i] == 1)
+            ok2 = DAY[d]["allow_d2"] and (sol[d, D2_IDX, i] == 1)
             return ok1 or ok2
 
         if kind == "late":
-            return (DAY[d]["req"]["ER_Late"] == 1) and (solver.Value(x[(d, L_IDX, i)]) == 1)
+            return (DAY[d]["req"]["ER_Late"] == 1) and (sol[d, L_IDX, i] == 1)
 
         if kind == "icu":
-            return (i in J2_idx) and DAY[d]["allow_icu"] and (solver.Value(x[(d, ICU_IDX, i)]) == 1)
+            return (i in J2_set) and DAY[d]["allow_icu"] and (sol[d, ICU_IDX, i] == 1)
 
         if kind == "vacation":
-            return solver.Value(x[(d, VAC_IDX, i)]) == 1
+            return sol[d, VAC_IDX, i] == 1
 
         # 未知の種類は満たせていない扱い
         return False
 
     # 人別・優先度別の総数/充足数をカウント
-    for _, r in prefs_now.iterrows():
-        d = all_days.index(r["date"])
-        i = name_to_idx[r["name"]]
-        k = r["kind"]
-        p = r["priority"]
-        if p not in ("B", "C"):
-            continue
-        ok = _sat(d, i, k)
-        if p == "B":
-            total_B[r["name"]] += 1
-            hit_B[r["name"]] += int(ok)
-        else:
-            total_C[r["name"]] += 1
-            hit_C[r["name"]] += int(ok)
-        if (not ok) and (len(unmet_examples) < 5):
-            unmet_examples.append(f"{r['date']} {r['name']}（{k}）")
+    bc = prefs_now[prefs_now["priority"].isin(["B", "C"])]
+    bc = bc.assign(ok=[bool(_sat(d, i, k)) for d, i, k in zip(bc["d"], bc["i"], bc["kind"])])
+    bc_agg = bc.groupby(["priority", "name"])["ok"].agg(["size", "sum"])
+    total_B = defaultdict(int); hit_B = defaultdict(int)
+    total_C = defaultdict(int); hit_C = defaultdict(int)
+    for (p, nm), n_tot, n_hit in bc_agg.itertuples(name=None):
+        tot_d, hit_d = (total_B, hit_B) if p == "B" else (total_C, hit_C)
+        tot_d[nm] = int(n_tot)
+        hit_d[nm] = int(n_hit)
+    # タイトルメッセージ用に、未充足の例を数件拾う
+    unmet_examples = [
+        f"{dd} {nm}（{k}）"
+        for dd, nm, k in bc.loc[~bc["ok"], ["date", "name", "kind"]].head(5).itertuples(index=False, name=None)
+    ]
 
     # ===== タイトルメッセージ（成功でも違反があれば必ず出す） =====
     total_unmet_B = sum(max(0, total_B[nm] - hit_B[nm]) for nm in names)
@@ -1872,13 +2191,16 @@ if run_btn:
         st.success("✅ 最適化に成功しました（B/C希望は全て充足）。")
         # ※ 全充足時は詳細メッセージは出さない
 
+    # 区分・ICU希望比率は人ごとに staff_df を引かず、配列で1回だけ取り出す
+    grade_arr   = staff_df["grade"].to_numpy()
+    desired_icu = staff_df["desired_icu_ratio"].to_numpy(dtype=np.float64)   # 0.0〜1.0
+
     # ===== J2のICU希望比率：未達アラート =====
     icu_shortfalls = []  # [(name, actual, target)]
     for j in J2_idx:
         nm = names[j]
-        desired = float(staff_df.iloc[j]["desired_icu_ratio"])  # 0.0〜1.0
-        target  = int(round(desired * int(per_person_total)))
-        actual  = sum(int(solver.Value(x[(d, ICU_IDX, j)])) for d in range(D))
+        target  = int(round(desired_icu[j] * int(per_person_total)))
+        actual  = int(sol[:, ICU_IDX, j].sum())
         if target > 0 and actual < target:
             icu_shortfalls.append((nm, actual, target))
     if icu_shortfalls:
@@ -1887,33 +2209,25 @@ if run_btn:
 
     # ===== 1) 日別スケジュール表（★=A希望反映、A休/B休/C休 表示） =====
     # B/C の「休み」が満たせた人を日別表示
-    from collections import defaultdict as _dd
-    B_off_want = _dd(set); C_off_want = _dd(set)
-    for _, r in prefs_now.iterrows():
-        if r["kind"] == "off":
-            d = all_days.index(r["date"])
-            if r["priority"] == "B":
-                B_off_want[d].add(r["name"])
-            elif r["priority"] == "C":
-                C_off_want[d].add(r["name"])
-
-    assigned_set_by_day = [set() for _ in range(D)]
-    for d in range(D):
-        for sidx in range(len(SHIFTS)):
-            for i in range(N):
-                if solver.Value(x[(d, sidx, i)]) == 1:
-                    assigned_set_by_day[d].add(names[i])
+    offs = prefs_now[prefs_now["kind"].eq("off")]
+    B_off_want = defaultdict(set, offs[offs["priority"].eq("B")].groupby("d")["name"].agg(set).to_dict())
+    C_off_want = defaultdict(set, offs[offs["priority"].eq("C")].groupby("d")["name"].agg(set).to_dict())
 
-    B_off_granted = {d: sorted([nm for nm in B_off_want.get(d, set()) if nm not in assigned_set_by_day[d]]) for d in range(D)}
-    C_off_granted = {d: sorted([nm for nm in C_off_want.get(d, set()) if nm not in assigned_set_by_day[d]]) for d in range(D)}
+    # 割当の有無は worked[d, i] を直接引く（日ごとの名前集合は作らない）
+    B_off_granted = {d: sorted(nm for nm in B_off_want.get(d, ()) if not worked[d, name_to_idx[nm]]) for d in range(D)}
+    C_off_granted = {d: sorted(nm for nm in C_off_want.get(d, ()) if not worked[d, name_to_idx[nm]]) for d in range(D)}
+
+    # ★表示用に A反映を (日, シフト) ごとにまとめておく（セルごとに A_star 全体を走査しない）
+    star_by_cell = defaultdict(set)
+    for dd, ss, nm in A_star:
+        star_by_cell[(dd, ss)].add(nm)
 
     rows = []
     for d in range(D):
         row = {"日付": str(all_days[d]), "曜日": WEEKDAY_JA[all_days[d].weekday()]}
-        for sname in SHIFTS:
-            sidx = SHIFTS.index(sname)
-            assigned = [names[i] for i in range(N) if solver.Value(x[(d, sidx, i)]) == 1]
-            starset  = {nm for (dd, ss, nm) in A_star if (dd == d and ss == sname)}
+        for sidx, sname in enumerate(SHIFTS):
+            assigned = [names[i] for i in np.flatnonzero(sol[d, sidx])]
+            starset  = star_by_cell.get((d, sname), ())
             labeled  = [(nm + "★") if (nm in starset) else nm for nm in assigned]
             row[SHIFT_LABEL.get(sname, sname)] = ",".join(labeled)
         # A/B/C 休み（満たせた人の一覧）
@@ -1927,37 +2241,29 @@ if run_btn:
     st.dataframe(out_df, use_container_width=True, hide_index=True)
 
     # ===== 2) 個人別集計（早/日1/日2/日3/遅番/ICU/年休、B/C分数表記、ICU希望達成、未達アラート） =====
-    hol_days_idx = [idx for idx, day in enumerate(all_days) if (day.weekday() >= 5 or day in holidays)]
+    hol_days_idx = np.flatnonzero(DAY_META["IS_HOL"]).tolist()
 
-    def _in_cell(lbl: str, di: int, nm: str) -> bool:
-        cell = out_df.loc[di, lbl]
-        if not isinstance(cell, str) or not cell:
-            return False
-        return nm in [x.strip("★") for x in cell.split(",") if x]
+    # 表の文字列を読み直さず、解の配列から人別に集計
+    cnt_all, hol_all, fat_all = compute_person_stats(sol, hol_days_idx)
 
     def _frac(hit: int, total: int) -> str:
         return "-" if total == 0 else f"{hit}/{total}"
 
     person_rows = []
     for i, nm in enumerate(names):
-        cnt = {lbl: sum(1 for d in range(D) if _in_cell(lbl, d, nm))
-               for lbl in ["早番", "日勤1", "日勤2", "日勤3", "遅番", "ICU", "年休"]}
+        cnt = {SHIFT_LABEL[sname]: int(cnt_all[i, k]) for k, sname in enumerate(SHIFTS)}
         total   = sum(cnt.values())
-        hol_cnt = sum(
-            sum(1 for lbl in ["早番", "日勤1", "日勤2", "日勤3", "遅番", "ICU"] if _in_cell(lbl, d, nm))
-            for d in hol_days_idx
-        )
-        fatigue = sum(1 for d in range(D - 1) if _in_cell("遅番", d, nm) and _in_cell("早番", d + 1, nm))
+        hol_cnt = int(hol_all[i])
+        fatigue = int(fat_all[i])
 
         # ICU希望（J2のみ目標あり）
-        desired_ratio = float(staff_df.iloc[i]["desired_icu_ratio"])
-        icu_target    = int(round(desired_ratio * int(per_person_total))) if staff_df.iloc[i]["grade"] == "J2" else 0
+        icu_target    = int(round(desired_icu[i] * int(per_person_total))) if i in J2_set else 0
         icu_actual    = cnt["ICU"]
         icu_col       = "-" if icu_target == 0 else f"{icu_actual}/{icu_target}"
 
         person_rows.append({
             "name": nm,
-            "grade": staff_df.iloc[i]["grade"],
+            "grade": grade_arr[i],
             **cnt,
             "B希望充足": _frac(hit_B[nm], total_B[nm]),
             "C希望充足": _frac(hit_C[nm], total_C[nm]),
@@ -2022,20 +2328,20 @@ if run_btn:
         fair_star=s_fairness, fair_slack_val=STAR_TO_FAIR_SLACK.get(s_fairness, 2)
     )
 
-    import io, json as _json
-    buf_json = io.StringIO(); buf_json.write(_json.dumps(json_snapshot, ensure_ascii=False, indent=2))
-    buf_csv  = io.StringIO(); out_df.to_csv(buf_csv, index=False)
+    # StringIO を経由せず、文字列として1回ずつ直接作る
+    json_text = json.dumps(json_snapshot, ensure_ascii=False, indent=2)
+    csv_text  = out_df.to_csv(index=False)
 
     c1, c2 = st.columns(2)
     with c1:
         st.download_button(
             "📥 スケジュールCSVをダウンロード",
-            data=buf_csv.getvalue(), file_name="schedule.csv", mime="text/csv"
+            data=csv_text, file_name="schedule.csv", mime="text/csv"
         )
     with c2:
         st.download_button(
             "🧾 スナップショットJSONをダウンロード",
-            data=buf_json.getvalue(), file_name="run_snapshot.json", mime="application/json"
+            data=json_text, file_name="run_snapshot.json", mime="application/json"
         )
 
     st.caption("🧾 スナップショットJSONは、条件や結果を丸ごと保存/復元できます。")